@@ -0,0 +1,73 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import FileField
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+AUTH_CACHE = 'auth'
+# Поля пользователя, которые не попадают в кэш.
+SECRET_FIELDS = frozenset({'password'})
+
+
+def token_cache_key(key):
+    # Сам токен в ключ не попадает: ключи кэша могут оказаться в логах.
+    return f'auth-token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def forget_tokens(keys):
+    """Удаляет снимки пользователей по токенам сразу и после фиксации."""
+
+    cache_keys = [token_cache_key(key) for key in keys]
+    if not cache_keys:
+        return
+    cache = caches[AUTH_CACHE]
+    cache.delete_many(cache_keys)
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+def user_snapshot(user):
+    """Значения колонок пользователя без хеша пароля.
+
+    Для файловых полей хранится имя: FieldFile ссылается на сам объект
+    пользователя и унес бы в кэш все его поля.
+    """
+
+    snapshot = {}
+    for field in type(user)._meta.concrete_fields:
+        if field.attname in SECRET_FIELDS:
+            continue
+        value = field.value_from_object(user)
+        if isinstance(field, FileField):
+            value = value.name
+        snapshot[field.attname] = value
+    return snapshot
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без обращения к базе на каждый запрос.
+
+    В кэше 'auth' на срок AUTH_TOKEN_CACHE_TIMEOUT хранится снимок
+    полей пользователя без хеша пароля. Пользователь из снимка получает
+    пароль отложенным полем: он читается из базы только при обращении и
+    не перезаписывается при save(). Снимок удаляется при удалении
+    токена и при сохранении пользователя: выходе, смене пароля,
+    деактивации.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = caches[AUTH_CACHE]
+        cache_key = token_cache_key(key)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            user = get_user_model().from_db(
+                'default', list(cached), list(cached.values())
+            )
+            return user, Token(key=key, user=user)
+        user, token = super().authenticate_credentials(key)
+        cache.set(cache_key, user_snapshot(user),
+                  settings.AUTH_TOKEN_CACHE_TIMEOUT)
+        return user, token
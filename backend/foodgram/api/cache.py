@@ -0,0 +1,165 @@
+import hashlib
+import threading
+import time
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import transaction
+
+RECIPES = 'recipes'
+INGREDIENTS = 'ingredients'
+# Счетчики избранного и корзин, от которых зависит только сортировка.
+POPULARITY = 'popularity'
+# Составы рецептов для индекса покрытия ингредиентами.
+COVERAGE = 'coverage'
+
+LOCK_TIMEOUT = 5
+LOCK_POLL_INTERVAL = 0.05
+
+
+def _version_key(namespace):
+    return f'version:{namespace}'
+
+
+def _now_version():
+    return time.time_ns() // 1000
+
+
+def relations_namespace(user_id):
+    """Пространство имен избранного, корзины и подписок пользователя."""
+    return f'relations:{user_id}'
+
+
+def cart_namespace(user_id):
+    """Пространство имен состава корзины пользователя."""
+    return f'cart:{user_id}'
+
+
+def get_version(namespace):
+    """Возвращает текущую версию данных пространства имен.
+
+    Версия - время последнего изменения в микросекундах, поэтому она
+    годится как Last-Modified, а после вытеснения ключа из кэша не
+    совпадет ни с одной из прежних.
+    """
+
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _now_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    """Сдвигает версию, делая недействительными все ключи с ней."""
+
+    key = _version_key(namespace)
+    version = max(_now_version(), (cache.get(key) or 0) + 1)
+    cache.set(key, version, None)
+    return version
+
+
+def invalidate(namespace):
+    """Сдвигает версию сразу и еще раз после фиксации транзакции.
+
+    Второй сдвиг не дает закэшировать данные, прочитанные конкурентным
+    запросом до фиксации, под уже новой версией.
+    """
+    bump_version(namespace)
+    transaction.on_commit(lambda: bump_version(namespace))
+
+
+def make_etag(*parts):
+    """ETag из значений, от которых зависит ответ."""
+    return hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def response_cache_key(namespaces, request, query_params):
+    """Ключ ответа по версиям namespaces и параметрам запроса."""
+
+    params = sorted(
+        (name, request.query_params[name])
+        for name in query_params
+        if name in request.query_params
+    )
+    url = f'{request.build_absolute_uri(request.path)}?{urlencode(params)}'
+    digest = hashlib.md5(url.encode()).hexdigest()
+    versions = ':'.join(
+        f'{namespace}-{get_version(namespace)}' for namespace in namespaces
+    )
+    return f'response:{versions}:{digest}'
+
+
+def get_or_build(key, build, timeout):
+    """Возвращает значение из кэша или строит его, защищая от лавины.
+
+    Значение хранится вместе с мягким сроком годности и живет в кэше
+    вдвое дольше. Перестраивает устаревшее значение только процесс,
+    взявший блокировку, остальные до этого отдают старое. Если значения
+    нет вовсе, остальные процессы недолго ждут результата блокировки.
+    """
+
+    entry = cache.get(key)
+    lock_key = f'{key}:lock'
+    if entry is not None:
+        expires_at, value = entry
+        if expires_at > time.time():
+            return value
+        if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+            return value
+        return _rebuild(key, lock_key, build, timeout)
+
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        return _rebuild(key, lock_key, build, timeout)
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+    return build()
+
+
+def _rebuild(key, lock_key, build, timeout):
+    try:
+        value = build()
+        cache.set(key, (time.time() + timeout, value), timeout * 2)
+    finally:
+        cache.delete(lock_key)
+    return value
+
+
+class VersionedIndex:
+    """Индекс в памяти процесса, перестраиваемый при смене версии.
+
+    Наследник задает namespace и реализует _build(), заполняющий
+    структуры индекса из базы. Если индекс умеет обновляться частично,
+    наследник переопределяет _refresh(), вызываемый при смене версии
+    уже построенного индекса.
+    """
+
+    namespace = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+
+    def ensure_fresh(self):
+        version = get_version(self.namespace)
+        if version == self._version:
+            return
+        with self._lock:
+            if version != self._version:
+                if self._version is None:
+                    self._build()
+                else:
+                    self._refresh()
+                self._version = version
+
+    def _build(self):
+        raise NotImplementedError
+
+    def _refresh(self):
+        self._build()
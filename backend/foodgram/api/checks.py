@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.checks import Error, register
+from PIL import ImageFont
+
+from api.shopping_list import FONT_SIZE
+
+
+@register()
+def check_shopping_list_font(app_configs, **kwargs):
+    """Шрифт PDF со списком покупок открывается при старте, а не в запросе."""
+
+    try:
+        ImageFont.truetype(settings.SHOPPING_LIST_FONT, FONT_SIZE)
+    except OSError as error:
+        return [Error(
+            f'SHOPPING_LIST_FONT не открывается: {error}',
+            hint='Укажите путь к TrueType-шрифту с кириллицей.',
+            id='api.E001',
+        )]
+    return []
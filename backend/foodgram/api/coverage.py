@@ -0,0 +1,130 @@
+import heapq
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from datetime import timedelta
+
+from django.utils import timezone
+
+from api.cache import COVERAGE, VersionedIndex
+from recipes.models import Recipe, RecipeIngredientValue
+
+# Запас на транзакции, зафиксированные позже своего updated_at.
+SYNC_OVERLAP = timedelta(minutes=1)
+
+
+class IngredientCoverageIndex(VersionedIndex):
+    """Инвертированный индекс: ингредиент -> отсортированный массив рецептов.
+
+    Отвечает, какие рецепты лучше всего покрываются набором ингредиентов,
+    не обращаясь к базе: обходятся только списки рецептов запрошенных
+    ингредиентов. Строится один раз, а при изменении составов рецептов
+    перечитывает только рецепты с новым updated_at.
+    """
+
+    namespace = COVERAGE
+
+    def __init__(self):
+        super().__init__()
+        # (ингредиент -> массив id рецептов, рецепт -> его ингредиенты)
+        self._data = ({}, {})
+        self._synced_at = None
+
+    def top(self, ingredient_ids, limit):
+        """Лучшие рецепты: кортежи (id рецепта, есть, нужно всего).
+
+        Рецепты упорядочены по доле имеющихся ингредиентов, затем по
+        их числу и новизне.
+        """
+
+        self.ensure_fresh()
+        postings, recipes = self._data
+        matched = Counter()
+        for ingredient_id in set(ingredient_ids):
+            matched.update(postings.get(ingredient_id, ()))
+        best = heapq.nlargest(
+            limit,
+            matched.items(),
+            key=lambda item: (item[1] / len(recipes[item[0]]), item[1],
+                              item[0]),
+        )
+        return [
+            (recipe_id, count, len(recipes[recipe_id]))
+            for recipe_id, count in best
+        ]
+
+    def discard(self, recipe_ids):
+        """Убирает из индекса удаленные рецепты."""
+        with self._lock:
+            self._apply(recipe_ids, {})
+
+    def _build(self):
+        started = timezone.now()
+        postings = {}
+        recipes = {}
+        rows = RecipeIngredientValue.objects.order_by(
+            'ingredient_id', 'recipe_id'
+        ).values_list('ingredient_id', 'recipe_id')
+        for ingredient_id, recipe_id in rows.iterator():
+            if ingredient_id not in postings:
+                postings[ingredient_id] = array('q')
+            postings[ingredient_id].append(recipe_id)
+            recipes[recipe_id] = recipes.get(recipe_id, ()) + (ingredient_id,)
+        self._data = (postings, recipes)
+        self._synced_at = started
+
+    def _refresh(self):
+        started = timezone.now()
+        changed = set(Recipe.objects.filter(
+            updated_at__gte=self._synced_at - SYNC_OVERLAP
+        ).values_list('pk', flat=True))
+        ingredients = {}
+        for recipe_id, ingredient_id in RecipeIngredientValue.objects.filter(
+            recipe_id__in=changed
+        ).values_list('recipe_id', 'ingredient_id'):
+            ingredients[recipe_id] = (
+                ingredients.get(recipe_id, ()) + (ingredient_id,)
+            )
+        self._apply(changed, ingredients)
+        self._synced_at = started
+
+    def _apply(self, recipe_ids, ingredients):
+        """Заменяет составы рецептов recipe_ids на ingredients.
+
+        Изменяемые массивы копируются, а новые структуры публикуются
+        одним присваиванием, поэтому читатели без блокировки видят либо
+        старый, либо новый индекс целиком.
+        """
+
+        postings, recipes = self._data
+        postings, recipes = dict(postings), dict(recipes)
+        copied = set()
+
+        def posting(ingredient_id):
+            if ingredient_id not in copied:
+                copied.add(ingredient_id)
+                postings[ingredient_id] = array(
+                    'q', postings.get(ingredient_id, ())
+                )
+            return postings[ingredient_id]
+
+        for recipe_id in recipe_ids:
+            old = set(recipes.pop(recipe_id, ()))
+            new = ingredients.get(recipe_id, ())
+            for ingredient_id in old - set(new):
+                recipe_ids_of = posting(ingredient_id)
+                index = bisect_left(recipe_ids_of, recipe_id)
+                if (index < len(recipe_ids_of)
+                        and recipe_ids_of[index] == recipe_id):
+                    del recipe_ids_of[index]
+                if not recipe_ids_of:
+                    del postings[ingredient_id]
+                    copied.discard(ingredient_id)
+            for ingredient_id in set(new) - old:
+                insort(posting(ingredient_id), recipe_id)
+            if new:
+                recipes[recipe_id] = tuple(new)
+        self._data = (postings, recipes)
+
+
+coverage_index = IngredientCoverageIndex()
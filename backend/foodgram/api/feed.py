@@ -0,0 +1,132 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Exists, OuterRef
+
+from api.pagination import KeysetPagination
+from recipes.models import FeedEntry, Recipe
+from users.models import UserFollow
+
+
+def fan_out(recipe):
+    """Рассылает новый рецепт в ленты подписчиков автора.
+
+    Если подписчиков больше FEED_FANOUT_MAX_FOLLOWERS, рецепт остается
+    неразосланным и попадает в ленты при чтении.
+    """
+
+    followers = list(UserFollow.objects.filter(
+        following=recipe.author_id
+    ).values_list('user_id', flat=True)[
+        :settings.FEED_FANOUT_MAX_FOLLOWERS + 1
+    ])
+    if len(followers) > settings.FEED_FANOUT_MAX_FOLLOWERS:
+        return
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, recipe=recipe,
+                      author_id=recipe.author_id, pub_date=recipe.pub_date)
+            for user_id in followers
+        ],
+        ignore_conflicts=True,
+    )
+    Recipe.objects.filter(pk=recipe.pk).update(in_timelines=True)
+    recipe.in_timelines = True
+
+
+def backfill_timeline(user_id, author_ids):
+    """Добавляет в ленту нового подписчика разосланные рецепты авторов."""
+
+    recipes = Recipe.objects.filter(
+        author_id__in=author_ids, in_timelines=True
+    ).values_list('id', 'author_id', 'pub_date')
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, recipe_id=recipe_id,
+                      author_id=author_id, pub_date=pub_date)
+            for recipe_id, author_id, pub_date in recipes
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def prune_timeline(user_id, author_ids):
+    """Убирает из ленты рецепты авторов, от которых пользователь отписался."""
+    FeedEntry.objects.filter(
+        user_id=user_id, author_id__in=author_ids
+    ).delete()
+
+
+class FeedPagination(KeysetPagination):
+    """Курсорная пагинация ленты подписок.
+
+    Лента сливается из разосланных записей FeedEntry и неразосланных
+    рецептов популярных авторов. Популярные - отслеживаемые авторы, у
+    которых есть рецепты с in_timelines=False, то есть на момент
+    публикации у них было больше FEED_FANOUT_MAX_FOLLOWERS подписчиков.
+    Из ленты и из частичного индекса каждого такого автора берется не
+    больше страницы после курсора, поэтому стоимость страницы зависит
+    только от числа популярных авторов, а не от всех подписок.
+    """
+
+    ordering = ('-pub_date', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(queryset.model, request)
+        limit = self.page_size + 1
+
+        user = request.user
+        popular = UserFollow.objects.filter(user=user).filter(Exists(
+            Recipe.objects.filter(author=OuterRef('following'),
+                                  in_timelines=False)
+        )).values_list('following_id', flat=True)
+        rows = self._window(FeedEntry.objects.filter(user=user),
+                            'recipe_id', position, reverse, limit)
+        rows.extend(self._windows(
+            [Recipe.objects.filter(author_id=author_id, in_timelines=False)
+             for author_id in popular],
+            'id', position, reverse, limit,
+        ))
+        rows.sort(reverse=not reverse)
+        ids = list(dict.fromkeys(pk for _, pk in rows))[:limit]
+
+        recipes = queryset.in_bulk(ids)
+        results = [recipes[pk] for pk in ids if pk in recipes]
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        self.page = results
+        return results
+
+    def _slice(self, source, key, position, reverse, limit):
+        ordering = ('-pub_date', f'-{key}')
+        if reverse:
+            ordering = tuple(self._invert(field) for field in ordering)
+        if position is not None:
+            source = source.filter(self._after(ordering, position))
+        return source.order_by(*ordering).values_list('pub_date', key)[
+            :limit
+        ]
+
+    def _window(self, source, key, position, reverse, limit):
+        """Не больше limit строк (pub_date, id) источника после курсора."""
+        return list(self._slice(source, key, position, reverse, limit))
+
+    def _windows(self, sources, key, position, reverse, limit):
+        """Окна нескольких источников: одним UNION ALL, если база умеет."""
+
+        slices = [
+            self._slice(source, key, position, reverse, limit)
+            for source in sources
+        ]
+        if len(slices) > 1 and (
+            connection.features.supports_slicing_ordering_in_compound
+        ):
+            return list(slices[0].union(*slices[1:], all=True))
+        return [row for window in slices for row in window]
@@ -0,0 +1,170 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+from rest_framework.authtoken.models import Token
+
+from api.authentication import forget_tokens
+from api.cache import RECIPES, invalidate
+from recipes.models import Recipe
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+# Вариант -> наибольшая сторона в пикселях.
+VARIANT_SIZES = {'thumbnail': 160, 'card': 480, 'full': 1280}
+# Расширение -> (формат Pillow, параметры сохранения). JPEG - запасной
+# вариант для клиентов без WebP.
+VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# Модель -> (поле изображения, поле с вариантами).
+IMAGE_FIELDS = {
+    Recipe: ('image', 'image_variants'),
+    User: ('avatar', 'avatar_variants'),
+}
+
+
+def variant_name(name, variant, extension):
+    """Путь варианта рядом с оригиналом: recipes/variants/x-card.webp."""
+
+    directory, base = posixpath.split(posixpath.splitext(name)[0])
+    return posixpath.join(directory, 'variants',
+                          f'{base}-{variant}.{extension}')
+
+
+def render_variants(storage, name):
+    """Сохраняет уменьшенные копии изображения, возвращает их пути.
+
+    Результат - {'source': name, вариант: {расширение: путь}}.
+    """
+
+    with storage.open(name) as file, Image.open(file) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        variants = {'source': name}
+        for variant, side in VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((side, side), Image.LANCZOS)
+            for extension, (fmt, options) in VARIANT_FORMATS.items():
+                frame = resized.convert('RGB') if fmt == 'JPEG' else resized
+                buffer = BytesIO()
+                frame.save(buffer, fmt, **options)
+                path = variant_name(name, variant, extension)
+                storage.delete(path)
+                variants.setdefault(variant, {})[extension] = storage.save(
+                    path, ContentFile(buffer.getvalue())
+                )
+    return variants
+
+
+def variant_paths(variants):
+    return {
+        path
+        for variant in VARIANT_SIZES
+        for path in variants.get(variant, {}).values()
+    }
+
+
+def build_variants(model, pk, name):
+    """Строит варианты изображения name объекта и сохраняет их пути.
+
+    Если изображение успело смениться, результат не записывается, а
+    построенные файлы удаляются; иначе удаляются файлы прежних
+    вариантов. Время изменения рецептов сдвигается, чтобы кэш фрагментов
+    их перестроил; снимки пользователя в кэше токенов удаляются.
+    """
+
+    field, variants_field = IMAGE_FIELDS[model]
+    storage = model._meta.get_field(field).storage
+    try:
+        previous = model.objects.filter(pk=pk).values_list(
+            variants_field, flat=True
+        ).first() or {}
+        variants = render_variants(storage, name)
+        updated = model.objects.filter(pk=pk, **{field: name}).update(
+            **{variants_field: variants}
+        )
+        if not updated:
+            previous = variants
+            variants = {}
+        for path in variant_paths(previous) - variant_paths(variants):
+            storage.delete(path)
+        if not updated:
+            return
+        Recipe.objects.filter(
+            **({'pk': pk} if model is Recipe else {'author': pk})
+        ).update(updated_at=timezone.now())
+        invalidate(RECIPES)
+        if model is User:
+            # update() не вызывает post_save, который забывает снимки.
+            forget_tokens(
+                Token.objects.filter(user=pk).values_list('key', flat=True)
+            )
+    except (OSError, Image.DecompressionBombError):
+        # Битое изображение: клиенты продолжают получать оригинал.
+        logger.warning('Cannot build variants of %s', name, exc_info=True)
+    except Exception:
+        logger.exception('Failed to build variants of %s', name)
+    finally:
+        if settings.IMAGE_VARIANT_WORKERS:
+            # Соединения потока пула не закрываются обработкой запроса.
+            connections.close_all()
+
+
+@lru_cache(maxsize=None)
+def _executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.IMAGE_VARIANT_WORKERS,
+        thread_name_prefix='image-variants',
+    )
+
+
+def schedule_variants(instance):
+    """Ставит построение вариантов в очередь после фиксации транзакции.
+
+    Варианты строит пул потоков процесса, вне обработки запроса. При
+    IMAGE_VARIANT_WORKERS = 0 они строятся сразу после фиксации.
+    """
+
+    model = type(instance)
+    field, variants_field = IMAGE_FIELDS[model]
+    name = getattr(instance, field).name
+    if not name or getattr(instance, variants_field).get('source') == name:
+        return
+    args = (model, instance.pk, name)
+    if settings.IMAGE_VARIANT_WORKERS:
+        transaction.on_commit(lambda: _executor().submit(build_variants,
+                                                         *args))
+    else:
+        transaction.on_commit(lambda: build_variants(*args))
+
+
+def variant_urls(request, image, variants):
+    """Адреса вариантов; пока они не готовы - адрес оригинала."""
+
+    if not image:
+        return None
+    if variants.get('source') != image.name:
+        variants = {}
+    build_url = request.build_absolute_uri if request else str
+    return {
+        variant: {
+            extension: build_url(
+                image.storage.url(variants[variant][extension])
+                if variant in variants else image.url
+            )
+            for extension in VARIANT_FORMATS
+        }
+        for variant in VARIANT_SIZES
+    }
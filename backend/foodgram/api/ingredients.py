@@ -0,0 +1,173 @@
+import gzip
+import hashlib
+from bisect import bisect_left
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+from api.cache import INGREDIENTS, VersionedIndex
+from recipes.models import Ingredient
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IDENTITY = 'identity'
+# mtime=0: иначе время сжатия попадает в заголовок, и байты под одним
+# сильным ETag различаются между процессами и пересборками.
+ENCODERS = {
+    'gzip': lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+}
+if brotli is not None:
+    ENCODERS['br'] = brotli.compress
+
+
+def normalize(name):
+    return name.casefold().replace('ё', 'е').strip()
+
+
+def trigrams(text):
+    """Триграммы слов текста, дополненных пробелами, как в pg_trgm."""
+
+    grams = set()
+    for word in text.split():
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class IngredientIndex(VersionedIndex):
+    """Отсортированный массив названий ингредиентов в памяти процесса.
+
+    Отвечает на подсказки при вводе без обращения к базе: сначала
+    ингредиенты, начинающиеся с запроса, затем содержащие его. Хранит
+    также готовый JSON полного списка и его сжатые варианты, а для
+    поиска с опечатками - списки ингредиентов по триграммам.
+    Загружается при первом запросе и после смены версии ингредиентов.
+    """
+
+    namespace = INGREDIENTS
+
+    def __init__(self):
+        super().__init__()
+        self._data = ([], [], {}, {}, [])
+
+    def payload(self, encoding):
+        """Тело полного списка в кодировке encoding и его ETag."""
+
+        self.ensure_fresh()
+        return self._data[2][encoding]
+
+    def similar(self, query, limit, threshold):
+        """Ингредиенты, похожие на запрос, по убыванию сходства.
+
+        Сходство - доля общих триграмм, как similarity() в pg_trgm.
+        """
+
+        self.ensure_fresh()
+        _, items, _, postings, sizes = self._data
+        grams = trigrams(normalize(query))
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(postings.get(gram, ()))
+        scored = []
+        for position, common in shared.items():
+            similarity = common / (len(grams) + sizes[position] - common)
+            if similarity >= threshold:
+                scored.append((-similarity, position))
+        scored.sort()
+        return [items[position] for _, position in scored[:limit]]
+
+    def search(self, query, limit):
+        """Возвращает до limit ингредиентов в виде словарей ответа API."""
+
+        self.ensure_fresh()
+        keys, items, *_ = self._data
+        query = normalize(query)
+        results = []
+        position = bisect_left(keys, query)
+        while (position < len(keys) and len(results) < limit
+               and keys[position].startswith(query)):
+            results.append(items[position])
+            position += 1
+        if len(results) < limit:
+            for key, item in zip(keys, items):
+                if query in key and not key.startswith(query):
+                    results.append(item)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def _build(self):
+        rows = sorted(
+            (normalize(name), pk, name, unit)
+            for pk, name, unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            )
+        )
+        keys = [key for key, *_ in rows]
+        items = [
+            {'id': pk, 'name': name, 'measurement_unit': unit}
+            for _, pk, name, unit in rows
+        ]
+        body = JSONRenderer().render(items)
+        payloads = {IDENTITY: body}
+        payloads.update(
+            (encoding, encode(body)) for encoding, encode in ENCODERS.items()
+        )
+        etag = hashlib.md5(body).hexdigest()
+        payloads = {
+            encoding: (encoded, f'{etag}-{encoding}')
+            for encoding, encoded in payloads.items()
+        }
+        postings = {}
+        sizes = []
+        for position, key in enumerate(keys):
+            grams = trigrams(key)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+        self._data = (keys, items, payloads, postings, sizes)
+
+
+ingredient_index = IngredientIndex()
+
+
+def similar_ingredients(query, limit):
+    """Поиск с опечатками: pg_trgm в PostgreSQL, иначе индекс в памяти."""
+
+    threshold = settings.INGREDIENT_SIMILARITY_THRESHOLD
+    if connection.vendor != 'postgresql':
+        return ingredient_index.similar(query, limit, threshold)
+    return list(
+        Ingredient.objects.filter(name__trigram_similar=query)
+        .annotate(similarity=TrigramSimilarity('name', query))
+        .filter(similarity__gte=threshold)
+        .order_by('-similarity', 'name')
+        .values('id', 'name', 'measurement_unit')[:limit]
+    )
+
+
+def choose_encoding(request):
+    """Лучшая поддерживаемая клиентом кодировка из Accept-Encoding."""
+
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding in ENCODERS and accepted.get(encoding, 0) > 0:
+            return encoding
+    return IDENTITY
@@ -0,0 +1,137 @@
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import serializers
+from rest_framework.response import Response
+
+from api.cache import get_or_build, make_etag, response_cache_key
+
+FIELDS_PARAM = 'fields'
+OMIT_PARAM = 'omit'
+
+
+def requested_fields(request, available):
+    """Поля ответа из available с учетом ?fields= и ?omit= (через запятую)."""
+
+    fields = set(available)
+    if request is None:
+        return fields
+    only = request.query_params.get(FIELDS_PARAM)
+    if only:
+        fields &= set(only.split(','))
+    omit = request.query_params.get(OMIT_PARAM)
+    if omit:
+        fields -= set(omit.split(','))
+    return fields
+
+
+class SparseFieldsetMixin:
+    """Сериализатор верхнего уровня отдает только запрошенные поля.
+
+    Отброшенные поля не вычисляются. Вложенные сериализаторы параметры
+    запроса не учитывают.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None:
+            return fields
+        keep = requested_fields(self.context.get('request'), fields)
+        return {
+            name: field for name, field in fields.items() if name in keep
+        }
+
+
+class AnonymousCacheMixin:
+    """Кэширует ответы list и retrieve для анонимных пользователей.
+
+    Ключ зависит от версий get_cache_namespaces(), которые сбрасываются
+    при изменении данных, и от параметров из cache_query_params.
+    """
+
+    cache_namespace = None
+    cache_query_params = ()
+
+    def get_cache_namespaces(self):
+        return (self.cache_namespace,)
+
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def _cached_response(self, handler, request, *args, **kwargs):
+        if not request.user.is_anonymous:
+            return handler(request, *args, **kwargs)
+        key = response_cache_key(
+            self.get_cache_namespaces(), request, self.cache_query_params
+        )
+        data = get_or_build(
+            key,
+            lambda: handler(request, *args, **kwargs).data,
+            settings.RESPONSE_CACHE_TIMEOUT,
+        )
+        return Response(data)
+
+
+class ConditionalGetMixin:
+    """Отвечает 304 Not Modified на list и retrieve без сериализации.
+
+    Наследник реализует get_validators(): ETag ответа и время последнего
+    изменения в секундах (или None, если ответ зависит не только от
+    времени изменения данных).
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional_response(
+            super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def get_object(self):
+        # Объект для валидаторов и для ответа выбирается одним запросом.
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+    def get_validators(self):
+        raise NotImplementedError
+
+    def _conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        fieldset = [
+            request.query_params.get(param, '')
+            for param in (FIELDS_PARAM, OMIT_PARAM)
+        ]
+        if any(fieldset):
+            # Разные наборы полей - разные представления ресурса.
+            etag = make_etag(etag, *fieldset)
+        return conditional_response(
+            request, etag, last_modified,
+            lambda: handler(request, *args, **kwargs)
+        )
+
+
+def conditional_response(request, etag, last_modified, build):
+    """Возвращает 304 при совпадении валидаторов, иначе ответ build()."""
+
+    etag = quote_etag(etag)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is None:
+        response = build()
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
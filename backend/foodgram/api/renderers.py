@@ -0,0 +1,33 @@
+import json
+
+from rest_framework import renderers
+
+
+class FileFormatRenderer(renderers.BaseRenderer):
+    """Объявляет формат файла для ?format=.
+
+    Сам файл представление отдает готовым ответом, через рендерер
+    проходят только ошибки, поэтому он выводит их как JSON.
+    """
+
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data, ensure_ascii=False).encode()
+
+
+class TextRenderer(FileFormatRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(FileFormatRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(FileFormatRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
@@ -0,0 +1,130 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import Case, F, IntegerField, When
+
+from api.cache import RECIPES, VersionedIndex
+from recipes.models import Recipe
+
+SEARCH_CONFIG = 'russian'
+NAME_WEIGHT = 1.0
+TEXT_WEIGHT = 0.4
+
+RECIPE_SEARCH_VECTOR = (
+    SearchVector('name', weight='A', config=SEARCH_CONFIG)
+    + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+)
+
+TOKEN_RE = re.compile(r'\w+')
+ENDINGS = 'аеиоуыэюяйь'
+MIN_STEM_LENGTH = 3
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+
+def stem(term):
+    """Отбрасывает гласное окончание: «молоко» совпадет с «молоке»."""
+    while len(term) > MIN_STEM_LENGTH and term[-1] in ENDINGS:
+        term = term[:-1]
+    return term
+
+
+def update_search_vector(recipe):
+    """Пересчитывает поисковый вектор рецепта в PostgreSQL."""
+    if connection.vendor == 'postgresql':
+        Recipe.objects.filter(pk=recipe.pk).update(
+            search_vector=RECIPE_SEARCH_VECTOR
+        )
+
+
+class RecipeSearchIndex(VersionedIndex):
+    """Инвертированный индекс рецептов в памяти процесса.
+
+    Запасной вариант полнотекстового поиска для баз без tsvector.
+    Индекс перестраивается, когда меняется версия рецептов. Слово
+    запроса без окончания совпадает со словами, которые с него
+    начинаются: это грубая замена стемминга словаря russian.
+    """
+
+    namespace = RECIPES
+
+    def __init__(self):
+        super().__init__()
+        # Слово -> {id рецепта: вес} и отсортированные слова. Кортеж
+        # заменяется целиком, поэтому поиск не видит половину сборки.
+        self._data = ({}, [])
+
+    def search(self, query):
+        """Возвращает id рецептов, содержащих все слова, по убыванию веса."""
+
+        terms = [stem(term) for term in tokenize(query)]
+        if not terms:
+            return []
+        self.ensure_fresh()
+        postings, tokens = self._data
+        scores = None
+        for term in terms:
+            term_scores = self._match(postings, tokens, term)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {
+                    recipe_id: score + term_scores[recipe_id]
+                    for recipe_id, score in scores.items()
+                    if recipe_id in term_scores
+                }
+            if not scores:
+                return []
+        return sorted(scores, key=lambda recipe_id: (-scores[recipe_id],
+                                                     -recipe_id))
+
+    @staticmethod
+    def _match(postings, tokens, term):
+        scores = defaultdict(float)
+        position = bisect_left(tokens, term)
+        while position < len(tokens) and tokens[position].startswith(term):
+            token = tokens[position]
+            for recipe_id, weight in postings[token].items():
+                scores[recipe_id] = max(scores[recipe_id], weight)
+            position += 1
+        return scores
+
+    def _build(self):
+        postings = defaultdict(lambda: defaultdict(float))
+        recipes = Recipe.objects.values_list('id', 'name', 'text')
+        for recipe_id, name, text in recipes.iterator():
+            for weight, field in ((NAME_WEIGHT, name), (TEXT_WEIGHT, text)):
+                for token in tokenize(field):
+                    postings[token][recipe_id] += weight
+        postings = {
+            token: dict(weights) for token, weights in postings.items()
+        }
+        self._data = (postings, sorted(postings))
+
+
+recipe_search_index = RecipeSearchIndex()
+
+
+def search_recipes(queryset, query):
+    """Фильтрует рецепты по тексту запроса и сортирует по релевантности."""
+
+    if connection.vendor == 'postgresql':
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return queryset.filter(search_vector=search_query).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank', '-pub_date', '-id')
+
+    recipe_ids = recipe_search_index.search(query)
+    if not recipe_ids:
+        return queryset.none()
+    return queryset.filter(pk__in=recipe_ids).order_by(Case(
+        *(When(pk=pk, then=position)
+          for position, pk in enumerate(recipe_ids)),
+        output_field=IntegerField(),
+    ))
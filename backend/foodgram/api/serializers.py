@@ -1,38 +1,151 @@
 import base64
+import binascii
+import hashlib
+import os
+import tempfile
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.base import File
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from PIL import Image
 from rest_framework import serializers
 from rest_framework.validators import UniqueTogetherValidator, ValidationError
 from rest_framework.relations import PrimaryKeyRelatedField
-from api.utils import create_relation_ingredient_and_value
+from api.images import variant_urls
+from api.mixins import SparseFieldsetMixin
+from api.utils import create_relation_ingredient_and_value, is_subscribed
 from recipes.models import Favourite, Ingredient, Recipe, RecipeIngredientValue
 
 
 MIN_COOKING_TIME = MIN_AMOUNT = 1
 MAX_COOKING_TIME = MAX_AMOUNT = 32_000
+BATCH_MAX_SIZE = 100
+BASE64_MARKER = ';base64,'
+DATA_URI_HEADER_LENGTH = 64
+# Кратно 4, чтобы каждая часть base64 декодировалась отдельно.
+DECODE_CHUNK_SIZE = 256 * 1024
 
 
 User = get_user_model()
 
 
 class Base64ImageField(serializers.ImageField):
+    """Изображение из data URI (data:image/...;base64,...).
+
+    Строка декодируется частями во временный файл, который остается в
+    памяти только до IMAGE_UPLOAD_SPOOL_SIZE байт. Размер проверяется
+    по длине строки до декодирования, формат и число пикселей - по
+    заголовку изображения, без распаковки пикселей.
+    """
+
     def to_internal_value(self, data):
         if isinstance(data, str):
             if data.startswith('data:image'):
-                try:
-                    format, imgstr = data.split(';base64,')
-                    ext = format.split('/')[-1]
-                    data = ContentFile(base64.b64decode(imgstr),
-                                       name=f'temp.{ext}')
-                except Exception:
-                    raise serializers.ValidationError('Invalid image format.')
+                return serializers.FileField.to_internal_value(
+                    self, self._decode(data)
+                )
             elif data.startswith('data:'):
                 raise serializers.ValidationError(
                     'Only image uploads are supported.'
                 )
         return super().to_internal_value(data)
 
+    @staticmethod
+    def _decode(data):
+        start = data.find(BASE64_MARKER, 0, DATA_URI_HEADER_LENGTH)
+        if start == -1:
+            raise serializers.ValidationError('Invalid image format.')
+        start += len(BASE64_MARKER)
+        padding = data.count('=', len(data) - 2)
+        if (len(data) - start) * 3 // 4 - padding > (
+            settings.IMAGE_UPLOAD_MAX_SIZE
+        ):
+            raise serializers.ValidationError(
+                'Image is larger than '
+                f'{settings.IMAGE_UPLOAD_MAX_SIZE} bytes.'
+            )
+
+        file = tempfile.SpooledTemporaryFile(
+            max_size=settings.IMAGE_UPLOAD_SPOOL_SIZE
+        )
+        try:
+            for position in range(start, len(data), DECODE_CHUNK_SIZE):
+                file.write(base64.b64decode(
+                    data[position:position + DECODE_CHUNK_SIZE],
+                    validate=True,
+                ))
+            file.seek(0)
+            with Image.open(file) as image:
+                image_format = image.format
+                width, height = image.size
+        except (binascii.Error, OSError, Image.DecompressionBombError):
+            file.close()
+            raise serializers.ValidationError('Invalid image format.')
+        if image_format not in settings.IMAGE_UPLOAD_FORMATS:
+            file.close()
+            raise serializers.ValidationError(
+                f'Unsupported image format: {image_format}.'
+            )
+        if width * height > settings.IMAGE_UPLOAD_MAX_PIXELS:
+            file.close()
+            raise serializers.ValidationError(
+                'Image has more than '
+                f'{settings.IMAGE_UPLOAD_MAX_PIXELS} pixels.'
+            )
+        if not Base64ImageField._is_intact(file):
+            file.close()
+            raise serializers.ValidationError('Invalid image format.')
+        upload = File(file, name=f'image.{image_format.lower()}')
+        upload.size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        return upload
+
+    @staticmethod
+    def _is_intact(file):
+        """Проверяет данные изображения, читая файл потоком.
+
+        verify() проходит по блокам файла (для PNG - с контрольными
+        суммами), не распаковывая пиксели. JPEG verify() не проверяет,
+        поэтому он декодируется в уменьшенном в 8 раз масштабе.
+        """
+
+        try:
+            file.seek(0)
+            with Image.open(file) as image:
+                image.verify()
+            file.seek(0)
+            with Image.open(file) as image:
+                if image.format == 'JPEG':
+                    image.draft(image.mode, (image.width // 8,
+                                             image.height // 8))
+                    image.load()
+        except Exception:
+            return False
+        return True
+
+
+class ImageVariantsField(serializers.Field):
+    """Адреса уменьшенных копий изображения модели.
+
+    Пока копии не построены, вместо них отдается оригинал.
+    """
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        return variant_urls(
+            self.context.get('request'),
+            getattr(instance, self.image_field),
+            getattr(instance, f'{self.image_field}_variants'),
+        )
+
 
 class IngredientSerializer(serializers.ModelSerializer):
     """Сериализатор для ингредиентов."""
@@ -65,26 +178,36 @@ class RecipeForUserSerializer(serializers.ModelSerializer):
         read_only_fields = ('__all__',)
 
 
-class UserSerializer(serializers.ModelSerializer):
+class RecipeCoverageSerializer(RecipeForUserSerializer):
+    """Сериализатор рецептов, подобранных по имеющимся ингредиентам."""
+
+    matched_ingredients = serializers.IntegerField(read_only=True)
+    total_ingredients = serializers.IntegerField(read_only=True)
+
+    class Meta(RecipeForUserSerializer.Meta):
+        fields = RecipeForUserSerializer.Meta.fields + (
+            'matched_ingredients', 'total_ingredients'
+        )
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Сериализатор для вывода автора-владельца рецепта."""
 
     is_subscribed = serializers.SerializerMethodField()
     avatar = Base64ImageField(required=False, allow_null=True)
+    avatar_variants = ImageVariantsField('avatar')
 
     class Meta:
         model = User
         fields = (
-            'email', 'id', 'username',
-            'first_name', 'last_name', 'is_subscribed', 'avatar'
+            'email', 'id', 'username', 'first_name', 'last_name',
+            'is_subscribed', 'avatar', 'avatar_variants',
         )
         read_only_fields = ('__all__',)
 
     def get_is_subscribed(self, obj):
         """Возвращает True, если текущий пользователь подписан на obj."""
-        user = self.context['request'].user
-        if user.is_anonymous or user == obj:
-            return False
-        return user.following.filter(following=obj).exists()
+        return is_subscribed(self.context.get('request'), obj)
 
 
 class RecipeIngredientValueSerializer(serializers.ModelSerializer):
@@ -100,38 +223,101 @@ class RecipeIngredientValueSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class RecipeReadSerializer(serializers.ModelSerializer):
-    """Сериализатор для просмотра списка рецептов или рецепта."""
+INGREDIENT_VALUES_PREFETCH = Prefetch(
+    'ingredient_values',
+    queryset=RecipeIngredientValue.objects.select_related(
+        'ingredient'
+    ).order_by('id')
+)
+
+
+class RecipeReadListSerializer(serializers.ListSerializer):
+    """Список рецептов, собираемый из закэшированных фрагментов."""
+
+    def to_representation(self, data):
+        return self.child.to_representation_many(list(data))
+
+
+class RecipeReadSerializer(SparseFieldsetMixin,
+                           serializers.ModelSerializer):
+    """Сериализатор для просмотра списка рецептов или рецепта.
+
+    Часть ответа, одинаковая для всех пользователей, кэшируется по id и
+    updated_at рецепта. Флаги текущего пользователя берутся из аннотаций
+    запроса и накладываются поверх фрагмента.
+    """
 
     author = UserSerializer(read_only=True)
     ingredients = RecipeIngredientValueSerializer(
         source='ingredient_values', many=True, read_only=True
     )
-    is_favorited = serializers.SerializerMethodField()
-    is_in_shopping_cart = serializers.SerializerMethodField()
+    is_favorited = serializers.BooleanField(read_only=True)
+    is_in_shopping_cart = serializers.BooleanField(read_only=True)
     image = Base64ImageField()
+    image_variants = ImageVariantsField('image')
 
     class Meta:
         model = Recipe
         fields = (
             'id', 'author', 'ingredients', 'is_favorited',
-            'is_in_shopping_cart', 'name', 'image', 'text', 'cooking_time',
+            'is_in_shopping_cart', 'name', 'image', 'image_variants', 'text',
+            'cooking_time',
         )
         read_only_fields = ('__all__',)
+        list_serializer_class = RecipeReadListSerializer
 
-    def get_is_favorited(self, obj):
-        """Проверка, находится ли рецепт в избранном."""
-        user = self.context['request'].user
-        if user.is_anonymous:
-            return False
-        return user.fav_recipes.filter(recipe=obj).exists()
+    def to_representation(self, instance):
+        return self.to_representation_many([instance])[0]
 
-    def get_is_in_shopping_cart(self, obj):
-        """Проверка, находится ли рецепт в корзине."""
-        user = self.context['request'].user
-        if user.is_anonymous:
-            return False
-        return user.cart.filter(recipe=obj).exists()
+    def to_representation_many(self, recipes):
+        """Представление рецептов с одним обращением к кэшу."""
+
+        keys = {recipe.pk: self._fragment_key(recipe) for recipe in recipes}
+        fragments = cache.get_many(keys.values())
+        missing = [
+            recipe for recipe in recipes if keys[recipe.pk] not in fragments
+        ]
+        if missing:
+            if 'ingredients' in self.fields:
+                prefetch_related_objects(missing, INGREDIENT_VALUES_PREFETCH)
+            rendered = {}
+            for recipe in missing:
+                self._pass_author_flag(recipe)
+                rendered[keys[recipe.pk]] = super().to_representation(recipe)
+            cache.set_many(rendered, settings.RECIPE_FRAGMENT_TIMEOUT)
+            fragments.update(rendered)
+        return [
+            self._with_user_flags(fragments[keys[recipe.pk]], recipe)
+            for recipe in recipes
+        ]
+
+    def _fragment_key(self, recipe):
+        # Адреса изображений абсолютные, поэтому ключ учитывает хост.
+        origin = self.context['request'].build_absolute_uri('/')
+        origin = hashlib.md5(origin.encode()).hexdigest()[:8]
+        fieldset = ','.join(self.fields)
+        fieldset = hashlib.md5(fieldset.encode()).hexdigest()[:8]
+        return (
+            f'recipe-fragment:{recipe.pk}:'
+            f'{recipe.updated_at.timestamp()}:{origin}:{fieldset}'
+        )
+
+    @staticmethod
+    def _pass_author_flag(recipe):
+        """Передает автору флаг подписки, посчитанный в запросе рецептов."""
+        if hasattr(recipe, 'is_author_subscribed'):
+            recipe.author.is_subscribed = recipe.is_author_subscribed
+
+    @staticmethod
+    def _with_user_flags(data, recipe):
+        for field in ('is_favorited', 'is_in_shopping_cart'):
+            if field in data:
+                data[field] = getattr(recipe, field, False)
+        if 'author' in data:
+            data['author']['is_subscribed'] = getattr(
+                recipe, 'is_author_subscribed', False
+            )
+        return data
 
 
 class RecipeWriteSerializer(serializers.ModelSerializer):
@@ -190,9 +376,12 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         """Обновление рецепта."""
         return self._save_recipe(validated_data, instance)
 
+    @transaction.atomic
     def _save_recipe(self, validated_data, instance=None):
         ingredients = validated_data.pop('ingredients', [])
 
+        # Списки покупок корзин с рецептом меняют сигналы удаления старых
+        # ингредиентов и create_relation_ingredient_and_value.
         if instance:
             for attr, value in validated_data.items():
                 setattr(instance, attr, value)
@@ -206,6 +395,16 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         return instance
 
 
+class BatchIdsSerializer(serializers.Serializer):
+    """Список id для пакетных операций."""
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BATCH_MAX_SIZE,
+    )
+
+
 class FavouriteSerializer(serializers.ModelSerializer):
     """Сериализатор для избранных рецептов."""
 
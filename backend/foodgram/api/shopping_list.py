@@ -0,0 +1,102 @@
+import csv
+import json
+import textwrap
+from functools import lru_cache
+from io import BytesIO, StringIO
+from itertools import chain
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont
+
+PAGE_SIZE = (1240, 1754)
+PAGE_RESOLUTION = 150
+MARGIN = 100
+FONT_SIZE = 28
+LINE_HEIGHT = 40
+LINE_WIDTH = 70
+
+
+def shopping_list_rows(user):
+    """Кортежи (название, единица, количество) серверным курсором."""
+
+    return (
+        user.shopping_list
+        .values_list('ingredient__name', 'ingredient__measurement_unit',
+                     'total_amount')
+        .order_by('ingredient__name')
+        .iterator()
+    )
+
+
+def _line(name, unit, amount):
+    return f'• {name} ({unit}) — {amount}'
+
+
+def render_txt(rows):
+    for row in rows:
+        yield f'{_line(*row)}\n'
+
+
+def render_csv(rows):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in chain([('name', 'measurement_unit', 'amount')], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def render_json(rows):
+    separator = '['
+    for name, unit, amount in rows:
+        yield separator + json.dumps(
+            {'name': name, 'measurement_unit': unit, 'amount': amount},
+            ensure_ascii=False,
+        )
+        separator = ','
+    yield ']' if separator == ',' else '[]'
+
+
+@lru_cache(maxsize=None)
+def _font():
+    # Наличие шрифта проверяет api.checks при старте.
+    return ImageFont.truetype(settings.SHOPPING_LIST_FONT, FONT_SIZE)
+
+
+def render_pdf(rows, title):
+    """PDF со списком покупок: страницы A4, текст шрифтом из настроек.
+
+    Страницы растровые, поэтому текст в PDF нельзя выделить или найти.
+    """
+
+    font = _font()
+    lines = chain(
+        [title, ''],
+        chain.from_iterable(
+            textwrap.wrap(_line(*row), LINE_WIDTH) for row in rows
+        ),
+    )
+    pages = []
+    draw = None
+    top = PAGE_SIZE[1]
+    for line in lines:
+        if top + LINE_HEIGHT > PAGE_SIZE[1] - MARGIN:
+            page = Image.new('L', PAGE_SIZE, 255)
+            pages.append(page)
+            draw = ImageDraw.Draw(page)
+            top = MARGIN
+        draw.text((MARGIN, top), line, font=font, fill=0)
+        top += LINE_HEIGHT
+    buffer = BytesIO()
+    pages[0].save(buffer, 'PDF', resolution=PAGE_RESOLUTION, save_all=True,
+                  append_images=pages[1:])
+    return buffer.getvalue()
+
+
+# Формат -> (тип содержимого, генератор частей файла).
+STREAMED_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', render_txt),
+    'csv': ('text/csv; charset=utf-8', render_csv),
+    'json': ('application/json', render_json),
+}
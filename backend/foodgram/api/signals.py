@@ -0,0 +1,218 @@
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.authentication import forget_tokens
+from api.cache import (COVERAGE, INGREDIENTS, RECIPES, cart_namespace,
+                       invalidate, relations_namespace)
+from api.feed import backfill_timeline, fan_out, prune_timeline
+from api.images import schedule_variants
+from api.search import update_search_vector
+from api.utils import (change_recipe_counter, change_shopping_lists,
+                       ingredient_amounts, recipe_carts)
+from cart.models import Cart
+from recipes.models import (Favourite, Ingredient, Recipe,
+                            RecipeIngredientValue)
+from users.models import UserFollow
+
+User = get_user_model()
+
+# Поля пользователя, которые попадают в ответы с рецептами.
+AUTHOR_FIELDS = frozenset(
+    ('username', 'first_name', 'last_name', 'email', 'avatar')
+)
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+@receiver([post_save, post_delete], sender=RecipeIngredientValue)
+def invalidate_recipes(**kwargs):
+    """Сбрасывает кэш ответов с рецептами."""
+    invalidate(RECIPES)
+
+
+@receiver([post_save, post_delete], sender=RecipeIngredientValue)
+def touch_recipe_composition(instance, **kwargs):
+    """Сдвигает updated_at рецепта с измененным составом.
+
+    По нему индекс покрытия перечитывает только измененные рецепты.
+    """
+    Recipe.objects.filter(pk=instance.recipe_id).update(
+        updated_at=timezone.now()
+    )
+    invalidate(COVERAGE)
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_search_vector(instance, **kwargs):
+    """Пересчитывает поисковый вектор сохраненного рецепта."""
+    update_search_vector(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(instance, created, **kwargs):
+    """Рассылает новый рецепт в ленты подписчиков."""
+    if created:
+        fan_out(instance)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=User)
+def build_image_variants(instance, **kwargs):
+    """Ставит в очередь уменьшенные копии нового изображения."""
+    schedule_variants(instance)
+
+
+@receiver(post_save, sender=UserFollow)
+def fill_timeline(instance, created, **kwargs):
+    """Добавляет в ленту рецепты автора, на которого подписались."""
+    if created:
+        backfill_timeline(instance.user_id, [instance.following_id])
+
+
+@receiver(post_delete, sender=UserFollow)
+def clear_timeline(instance, **kwargs):
+    """Убирает из ленты рецепты автора после отписки."""
+    prune_timeline(instance.user_id, [instance.following_id])
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def invalidate_ingredients(**kwargs):
+    """Сбрасывает версию списка ингредиентов."""
+    invalidate(INGREDIENTS)
+
+
+@receiver([post_save, post_delete], sender=Favourite)
+@receiver([post_save, post_delete], sender=Cart)
+@receiver([post_save, post_delete], sender=UserFollow)
+def invalidate_relations(instance, **kwargs):
+    """Сбрасывает версию избранного, корзины и подписок пользователя."""
+    invalidate(relations_namespace(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=Cart)
+def invalidate_cart(instance, **kwargs):
+    """Сбрасывает версию корзины, от которой зависит список покупок."""
+    invalidate(cart_namespace(instance.user_id))
+
+
+# Списки покупок следуют за корзинами и составом рецептов. Вставки и
+# удаления в обход сигналов (insert_relation, add_relations, bulk_create)
+# вызывают change_shopping_lists сами. При удалении рецепта его корзины
+# и ингредиенты удаляются в любом порядке: то, что удалено вторым, уже
+# не находит пары, поэтому каждая позиция вычитается один раз.
+
+
+@receiver(post_save, sender=Cart)
+def add_to_shopping_list(instance, created, **kwargs):
+    """Прибавляет рецепт, добавленный в корзину, к списку покупок."""
+    if created:
+        change_shopping_lists([instance.user_id],
+                              ingredient_amounts([instance.recipe_id]))
+
+
+@receiver(post_delete, sender=Cart)
+def remove_from_shopping_list(instance, **kwargs):
+    """Вычитает рецепт, убранный из корзины, из списка покупок."""
+    change_shopping_lists([instance.user_id],
+                          ingredient_amounts([instance.recipe_id]), sign=-1)
+
+
+# Счетчики favorites_count и carts_count следуют за строками так же:
+# пути в обход сигналов вызывают change_recipe_counter сами.
+RECIPE_COUNTERS = {Favourite: 'favorites_count', Cart: 'carts_count'}
+
+
+@receiver(post_save, sender=Favourite)
+@receiver(post_save, sender=Cart)
+def increase_recipe_counter(sender, instance, created, **kwargs):
+    """Увеличивает счетчик рецепта, добавленного в избранное/корзину."""
+    if created:
+        change_recipe_counter(RECIPE_COUNTERS[sender], 1,
+                              [instance.recipe_id])
+
+
+@receiver(post_delete, sender=Favourite)
+@receiver(post_delete, sender=Cart)
+def decrease_recipe_counter(sender, instance, **kwargs):
+    """Уменьшает счетчик рецепта, убранного из избранного/корзины."""
+    change_recipe_counter(RECIPE_COUNTERS[sender], -1, [instance.recipe_id])
+
+
+@receiver(pre_save, sender=RecipeIngredientValue)
+def remember_ingredient_value(instance, **kwargs):
+    """Запоминает прежние ингредиент и количество изменяемой строки."""
+    instance.stored_value = RecipeIngredientValue.objects.filter(
+        pk=instance.pk
+    ).values_list('ingredient_id', 'amount').first() if instance.pk else None
+
+
+@receiver(post_save, sender=RecipeIngredientValue)
+def change_ingredient_value(instance, **kwargs):
+    """Переносит изменение состава рецепта в списки покупок корзин."""
+    deltas = Counter({instance.ingredient_id: instance.amount})
+    if instance.stored_value:
+        ingredient_id, amount = instance.stored_value
+        deltas[ingredient_id] -= amount
+    change_shopping_lists(recipe_carts(instance.recipe_id), deltas)
+
+
+@receiver(post_delete, sender=RecipeIngredientValue)
+def remove_ingredient_value(instance, **kwargs):
+    """Вычитает удаленный ингредиент рецепта из списков покупок."""
+    change_shopping_lists(recipe_carts(instance.recipe_id),
+                          {instance.ingredient_id: instance.amount}, sign=-1)
+
+
+@receiver(post_save, sender=Ingredient)
+def invalidate_recipes_on_ingredient_change(instance, created, **kwargs):
+    """Обновляет рецепты, в которых изменился ингредиент."""
+    if not created:
+        Recipe.objects.filter(ingredients=instance).update(
+            updated_at=timezone.now()
+        )
+        invalidate(RECIPES)
+
+
+@receiver(pre_save, sender=User)
+def remember_author_fields(instance, update_fields=None, **kwargs):
+    """Запоминает прежние поля автора, которые может изменить запись."""
+    instance.stored_author = User.objects.filter(
+        pk=instance.pk
+    ).values(*AUTHOR_FIELDS).first() if instance.pk and (
+        update_fields is None or AUTHOR_FIELDS & set(update_fields)
+    ) else None
+
+
+@receiver(post_save, sender=User)
+def invalidate_recipes_on_author_change(instance, created, **kwargs):
+    """Обновляет рецепты автора при изменении его профиля."""
+    stored = instance.stored_author
+    if created or not stored:
+        return
+    # Пустой аватар хранится как NULL, а читается как файл без имени.
+    if any((stored[field] or '') != (getattr(instance, field) or '')
+           for field in AUTHOR_FIELDS):
+        Recipe.objects.filter(author=instance).update(
+            updated_at=timezone.now()
+        )
+        invalidate(RECIPES)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(instance, **kwargs):
+    """Забывает снимок пользователя по удаленному токену (выход)."""
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(instance, created, **kwargs):
+    """Забывает снимки пользователя после смены пароля, деактивации и
+    любого другого сохранения профиля."""
+    if not created:
+        forget_tokens(
+            Token.objects.filter(user=instance).values_list('key', flat=True)
+        )
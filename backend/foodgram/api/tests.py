@@ -1,14 +1,43 @@
+import base64
+import gzip
+import json
+import os
+import pickle
 from http import HTTPStatus
-from django.test import Client, TestCase
+import tempfile
+import tracemalloc
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import skipIf
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
 
-from recipes.models import Recipe, Ingredient, RecipeIngredientValue
+from api.authentication import CachedTokenAuthentication, token_cache_key
+from api.cache import get_or_build
+from api.checks import check_shopping_list_font
+from api.images import build_variants
+from api.ingredients import brotli
+from api.serializers import Base64ImageField
+from cart.models import Cart
+from recipes.models import (Favourite, Ingredient, Recipe,
+                            RecipeIngredientValue)
+from users.models import UserFollow
 
 User = get_user_model()
 
 
 class RecipeViewSetTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.guest_client = Client()
         self.user = User.objects.create_user(username='testuser',
                                              password='pass')
@@ -41,7 +70,7 @@ class RecipeViewSetTestCase(TestCase):
     def test_get_link(self):
         response = self.guest_client.get(
             f'/api/recipes/{self.recipe.id}/get-link/'
-            )
+        )
         self.assertEqual(response.status_code, HTTPStatus.OK)
         self.assertIn('short-link', response.json())
 
@@ -52,6 +81,428 @@ class RecipeViewSetTestCase(TestCase):
         self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
 
 
+class RecipeUserFlagsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='flags',
+                                             email='flags@test.ru',
+                                             password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.favourite = Recipe.objects.create(name='Избранный',
+                                               author=self.user,
+                                               cooking_time=5)
+        self.in_cart = Recipe.objects.create(name='В корзине',
+                                             author=self.user,
+                                             cooking_time=5)
+        Favourite.objects.create(user=self.user, recipe=self.favourite)
+        Cart.objects.create(user=self.user, recipe=self.in_cart)
+
+    def test_flags_in_list(self):
+        response = self.client.get('/api/recipes/')
+        flags = {
+            item['id']: (item['is_favorited'], item['is_in_shopping_cart'])
+            for item in response.json()['results']
+        }
+        self.assertEqual(flags[self.favourite.id], (True, False))
+        self.assertEqual(flags[self.in_cart.id], (False, True))
+
+    def test_filter_by_flags(self):
+        response = self.client.get('/api/recipes/?is_favorited=1')
+        self.assertEqual(
+            [item['id'] for item in response.json()['results']],
+            [self.favourite.id]
+        )
+        response = self.client.get('/api/recipes/?is_in_shopping_cart=1')
+        self.assertEqual(
+            [item['id'] for item in response.json()['results']],
+            [self.in_cart.id]
+        )
+
+    def test_flags_for_guest(self):
+        response = APIClient().get(f'/api/recipes/{self.favourite.id}/')
+        self.assertFalse(response.json()['is_favorited'])
+        self.assertFalse(response.json()['is_in_shopping_cart'])
+
+
+class RecipeListQueriesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user(username='reader',
+                                               email='reader@test.ru',
+                                               password='pass')
+        self.author = User.objects.create_user(username='author',
+                                               email='author@test.ru',
+                                               password='pass')
+        UserFollow.objects.create(user=self.reader, following=self.author)
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        ingredients = [
+            Ingredient.objects.create(name=f'ингредиент {i}',
+                                      measurement_unit='г')
+            for i in range(3)
+        ]
+        for i in range(10):
+            recipe = Recipe.objects.create(name=f'Рецепт {i}',
+                                           author=self.author,
+                                           cooking_time=10)
+            for ingredient in ingredients:
+                RecipeIngredientValue.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=i + 1
+                )
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        # COUNT, страница рецептов и ингредиенты; ETag строится из версий.
+        for limit in (1, 10):
+            with self.assertNumQueries(3):
+                response = self.client.get(f'/api/recipes/?limit={limit}')
+            self.assertEqual(len(response.json()['results']), limit)
+        # Курсорная страница из закэшированных фрагментов - один запрос.
+        with self.assertNumQueries(1):
+            self.client.get('/api/recipes/?cursor=&limit=1')
+
+    def test_cached_fragments_skip_ingredient_queries(self):
+        self.client.get('/api/recipes/?limit=10')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/recipes/?limit=10')
+        self.assertEqual(len(response.json()['results'][0]['ingredients']),
+                         3)
+
+    def test_fragments_overlay_viewer_flags(self):
+        recipe = Recipe.objects.first()
+        self.client.get('/api/recipes/?limit=1')
+        Favourite.objects.create(user=self.reader, recipe=recipe)
+        data = self.client.get('/api/recipes/?limit=1').json()['results'][0]
+        self.assertTrue(data['is_favorited'])
+        guest = APIClient().get(f'/api/recipes/{recipe.id}/').json()
+        self.assertFalse(guest['is_favorited'])
+        self.assertFalse(guest['author']['is_subscribed'])
+
+    def test_author_subscription_flag(self):
+        response = self.client.get('/api/recipes/?limit=1')
+        recipe = response.json()['results'][0]
+        self.assertTrue(recipe['author']['is_subscribed'])
+        self.assertEqual(len(recipe['ingredients']), 3)
+
+
+class RecipeCursorPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        author = User.objects.create_user(username='cursor',
+                                          email='cursor@test.ru',
+                                          password='pass')
+        self.recipes = [
+            Recipe.objects.create(name=f'Рецепт {i}', author=author,
+                                  cooking_time=10)
+            for i in range(5)
+        ]
+
+    def test_walk_forward_and_back(self):
+        response = self.client.get('/api/recipes/?cursor=&limit=2')
+        data = response.json()
+        self.assertNotIn('count', data)
+        self.assertIsNone(data['previous'])
+        seen = [item['id'] for item in data['results']]
+        while data['next']:
+            data = self.client.get(data['next']).json()
+            seen += [item['id'] for item in data['results']]
+        expected = [recipe.id for recipe in reversed(self.recipes)]
+        self.assertEqual(seen, expected)
+
+        data = self.client.get(data['previous']).json()
+        self.assertEqual([item['id'] for item in data['results']],
+                         expected[2:4])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/?cursor=broken')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+class RecipeResponseCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.author = User.objects.create_user(username='cached',
+                                               email='cached@test.ru',
+                                               password='pass')
+        self.recipe = Recipe.objects.create(name='Рецепт', author=self.author,
+                                            cooking_time=10)
+
+    def test_guest_responses_are_cached(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.json()['name'], 'Рецепт')
+        self.client.get('/api/recipes/?limit=2&page=1')
+        with self.assertNumQueries(0):
+            self.client.get('/api/recipes/?page=1&limit=2&ignored=1')
+
+    def test_cache_invalidated_on_changes(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        self.recipe.name = 'Новое название'
+        self.recipe.save()
+        self.assertEqual(self.client.get(url).json()['name'],
+                         'Новое название')
+        self.author.first_name = 'Автор'
+        self.author.save(update_fields=['first_name'])
+        self.assertEqual(
+            self.client.get(url).json()['author']['first_name'], 'Автор'
+        )
+
+    def test_unrelated_user_save_keeps_cache(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        updated_at = Recipe.objects.get(pk=self.recipe.pk).updated_at
+        self.author.last_login = timezone.now()
+        self.author.save()
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).updated_at,
+                         updated_at)
+
+    def test_stale_value_served_while_rebuilding(self):
+        cache.set('key', (0, 'stale'), 60)
+        cache.add('key:lock', 1, 5)
+        self.assertEqual(get_or_build('key', lambda: 'fresh', 60), 'stale')
+        cache.delete('key:lock')
+        self.assertEqual(get_or_build('key', lambda: 'fresh', 60), 'fresh')
+
+    def test_cursor_mode_has_own_key(self):
+        self.client.get('/api/recipes/')
+        response = self.client.get('/api/recipes/?cursor=')
+        self.assertNotIn('count', response.json())
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='etag',
+                                             email='etag@test.ru',
+                                             password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipe = Recipe.objects.create(name='Рецепт', author=self.user,
+                                            cooking_time=10)
+
+    def assertNotModified(self, url, client=None):
+        client = client or self.client
+        etag = client.get(url)['ETag']
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        return etag
+
+    def test_read_endpoints_answer_not_modified(self):
+        for url in ('/api/recipes/', f'/api/recipes/{self.recipe.id}/',
+                    '/api/users/me/', '/api/ingredients/'):
+            with self.subTest(url=url):
+                self.assertNotModified(url)
+        self.assertNotModified('/api/recipes/', APIClient())
+
+    def test_etag_follows_user_flags(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        list_etag = self.assertNotModified('/api/recipes/')
+        detail_etag = self.assertNotModified(url)
+        Favourite.objects.create(user=self.user, recipe=self.recipe)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.json()['is_favorited'])
+        response = self.client.get('/api/recipes/',
+                                   HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_guest_last_modified(self):
+        response = APIClient().get('/api/recipes/')
+        response = APIClient().get(
+            '/api/recipes/',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+
+class RecipeSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        author = User.objects.create_user(username='search',
+                                          email='search@test.ru',
+                                          password='pass')
+        self.pancakes = Recipe.objects.create(
+            name='Блины на молоке', text='Тонкие блинчики.',
+            author=author, cooking_time=30
+        )
+        self.soup = Recipe.objects.create(
+            name='Суп', text='Подавать с блинами и сметаной.',
+            author=author, cooking_time=60
+        )
+        Recipe.objects.create(name='Салат', text='Огурцы и помидоры.',
+                              author=author, cooking_time=10)
+
+    def search(self, query):
+        response = self.client.get('/api/recipes/', {'search': query})
+        return [item['id'] for item in response.json()['results']]
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(self.search('блин'),
+                         [self.pancakes.id, self.soup.id])
+
+    def test_all_words_required(self):
+        self.assertEqual(self.search('блины молоко'), [self.pancakes.id])
+        self.assertEqual(self.search('торт'), [])
+
+    def test_index_follows_changes(self):
+        self.search('суп')
+        self.soup.name = 'Борщ'
+        self.soup.save()
+        self.assertEqual(self.search('борщ'), [self.soup.id])
+
+    def test_cursor_needs_explicit_ordering(self):
+        response = self.client.get('/api/recipes/',
+                                   {'search': 'блин', 'cursor': ''})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('cursor', response.json())
+        response = self.client.get('/api/recipes/', {
+            'search': 'блин', 'cursor': '', 'ordering': '-pub_date',
+        })
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+
+class CanCookTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        author = User.objects.create_user(username='cook',
+                                          email='cook@test.ru',
+                                          password='pass')
+        self.eggs, self.milk, self.flour = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('яйца', 'молоко', 'мука')
+        )
+        self.omelette = self.create_recipe(author, 'Омлет',
+                                           self.eggs, self.milk)
+        self.pancakes = self.create_recipe(author, 'Блины',
+                                           self.eggs, self.milk, self.flour)
+
+    @staticmethod
+    def create_recipe(author, name, *ingredients):
+        recipe = Recipe.objects.create(name=name, author=author,
+                                       cooking_time=10)
+        for ingredient in ingredients:
+            RecipeIngredientValue.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=1
+            )
+        return recipe
+
+    def can_cook(self, *ingredients):
+        ids = ','.join(str(ingredient.id) for ingredient in ingredients)
+        return self.client.get(f'/api/recipes/can_cook/?ingredients={ids}')
+
+    def test_ranked_by_coverage(self):
+        data = self.can_cook(self.eggs, self.milk).json()
+        self.assertEqual(
+            [(item['id'], item['matched_ingredients'],
+              item['total_ingredients']) for item in data],
+            [(self.omelette.id, 2, 2), (self.pancakes.id, 2, 3)]
+        )
+
+    def test_index_follows_recipe_changes(self):
+        self.can_cook(self.flour)
+        bread = self.create_recipe(self.omelette.author, 'Хлеб', self.flour)
+        # Перечитываются только составы рецептов с новым updated_at.
+        with CaptureQueriesContext(connection) as queries:
+            data = self.can_cook(self.flour).json()
+        self.assertEqual(data[0]['id'], bread.id)
+        self.assertIn('"updated_at" >=', queries[0]['sql'])
+        self.assertIn('IN', queries[1]['sql'])
+
+        bread.ingredient_values.update(ingredient=self.milk)
+        RecipeIngredientValue.objects.filter(recipe=bread).first().save()
+        self.assertNotIn(bread.id,
+                         [item['id'] for item in self.can_cook(self.flour)
+                          .json()])
+        self.pancakes.delete()
+        self.assertEqual(self.can_cook(self.flour).json(), [])
+
+    def test_ingredients_required(self):
+        response = self.client.get('/api/recipes/can_cook/?ingredients=x')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class RecipePopularityTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='fan',
+                                             email='fan@test.ru',
+                                             password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.popular = Recipe.objects.create(name='Популярный',
+                                             author=self.user,
+                                             cooking_time=10)
+        self.fresh = Recipe.objects.create(name='Новый', author=self.user,
+                                           cooking_time=10)
+
+    def test_counters_follow_endpoints(self):
+        url = f'/api/recipes/{self.popular.id}'
+        self.client.post(f'{url}/favorite/')
+        self.client.post(f'{url}/shopping_cart/')
+        self.popular.refresh_from_db()
+        self.assertEqual(
+            (self.popular.favorites_count, self.popular.carts_count), (1, 1)
+        )
+        self.client.delete(f'{url}/favorite/')
+        self.client.delete(f'{url}/favorite/')
+        self.client.delete(f'{url}/shopping_cart/')
+        self.popular.refresh_from_db()
+        self.assertEqual(
+            (self.popular.favorites_count, self.popular.carts_count), (0, 0)
+        )
+
+    def test_order_by_popularity(self):
+        urls = ('/api/recipes/?ordering=-favorites_count',
+                '/api/recipes/?ordering=-favorites_count&cursor=')
+        # Кэш гостевых ответов и ETag сбрасываются при смене счетчиков.
+        etags = {url: APIClient().get(url)['ETag'] for url in urls}
+        self.client.post(f'/api/recipes/{self.popular.id}/favorite/')
+        for url in urls:
+            with self.subTest(url=url):
+                response = APIClient().get(url,
+                                           HTTP_IF_NONE_MATCH=etags[url])
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.assertEqual(
+                    [item['id'] for item in response.json()['results']],
+                    [self.popular.id, self.fresh.id]
+                )
+
+    def test_counters_follow_model_changes(self):
+        other = User.objects.create_user(username='other',
+                                         email='other@test.ru',
+                                         password='pass')
+        Favourite.objects.create(user=other, recipe=self.popular)
+        Cart.objects.create(user=other, recipe=self.popular)
+        self.popular.refresh_from_db()
+        self.assertEqual(
+            (self.popular.favorites_count, self.popular.carts_count), (1, 1)
+        )
+        # Удаление пользователя каскадом удаляет его избранное и корзину.
+        other.delete()
+        self.popular.refresh_from_db()
+        self.assertEqual(
+            (self.popular.favorites_count, self.popular.carts_count), (0, 0)
+        )
+
+    def test_reconcile_counters(self):
+        # bulk_create не отправляет сигналы, и счетчик отстает.
+        Favourite.objects.bulk_create(
+            [Favourite(user=self.user, recipe=self.fresh)]
+        )
+        call_command('reconcile_counters', stdout=StringIO())
+        self.fresh.refresh_from_db()
+        self.assertEqual(self.fresh.favorites_count, 1)
+
+
 class IngredientViewSetTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -66,3 +517,760 @@ class IngredientViewSetTestCase(TestCase):
         response = self.client.get('/api/ingredients/?name=сах')
         self.assertEqual(response.status_code, HTTPStatus.OK)
         self.assertIn('сахар', response.content.decode())
+
+    def test_prefix_matches_before_substring(self):
+        Ingredient.objects.create(name='ванильный сахар', measurement_unit='г')
+        Ingredient.objects.create(name='сахарная пудра', measurement_unit='г')
+        response = self.client.get('/api/ingredients/?name=Сахар')
+        self.assertEqual(
+            [item['name'] for item in response.json()],
+            ['сахар', 'сахарная пудра', 'ванильный сахар']
+        )
+        response = self.client.get('/api/ingredients/?name=сахар&limit=1')
+        self.assertEqual(len(response.json()), 1)
+
+    def test_search_served_from_memory(self):
+        self.client.get('/api/ingredients/?name=са')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/ingredients/?name=сах')
+        self.assertEqual(response.json()[0]['id'], self.ingredient.id)
+        Ingredient.objects.create(name='сахарин', measurement_unit='г')
+        response = self.client.get('/api/ingredients/?name=сахари')
+        self.assertEqual(response.json()[0]['name'], 'сахарин')
+
+    def test_typo_falls_back_to_similar_names(self):
+        Ingredient.objects.create(name='майонез', measurement_unit='г')
+        Ingredient.objects.create(name='майоран', measurement_unit='г')
+        response = self.client.get('/api/ingredients/?name=маеонез')
+        self.assertEqual(
+            [item['name'] for item in response.json()], ['майонез']
+        )
+        response = self.client.get('/api/ingredients/?name=кефир')
+        self.assertEqual(response.json(), [])
+
+    def test_full_list_is_precompressed(self):
+        plain = self.client.get('/api/ingredients/')
+        self.assertEqual(plain.json()[0]['name'], 'сахар')
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        compressed = self.client.get('/api/ingredients/',
+                                     HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        # Время сжатия не попадает в заголовок: байты воспроизводимы.
+        self.assertEqual(compressed.content[4:8], bytes(4))
+        self.assertNotEqual(compressed['ETag'], plain['ETag'])
+        response = self.client.get('/api/ingredients/',
+                                   HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_full_list_prefers_brotli(self):
+        plain = self.client.get('/api/ingredients/')
+        compressed = self.client.get('/api/ingredients/',
+                                     HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(compressed['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(compressed.content),
+                         plain.content)
+
+
+class LoadIngredientsTestCase(TestCase):
+    def load(self, name, content):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / name
+        path.write_text(content, encoding='utf-8')
+        out = StringIO()
+        call_command('load_ingredients', str(path), stdout=out)
+        return out.getvalue()
+
+    def test_csv_is_loaded_once(self):
+        content = 'соль,г\nсахар,г\nсоль,г\n'
+        self.assertIn('added: 2', self.load('ingredients.csv', content))
+        with self.assertNumQueries(1):
+            output = self.load('ingredients.csv', content)
+        self.assertIn('added: 0', output)
+        self.assertEqual(Ingredient.objects.count(), 2)
+
+    def test_json_is_streamed(self):
+        content = (
+            '[{"name": "мука", "measurement_unit": "г"},\n'
+            ' {"name": "молоко", "measurement_unit": "мл"}]'
+        )
+        self.assertIn('added: 2', self.load('ingredients.json', content))
+        self.assertTrue(Ingredient.objects.filter(
+            name='молоко', measurement_unit='мл'
+        ).exists())
+
+
+class ShoppingListExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='cook', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        flour = Ingredient.objects.create(name='мука', measurement_unit='г')
+        for amount in (5, 10):
+            recipe = Recipe.objects.create(
+                name=f'Хлеб {amount}', author=self.user, text='текст',
+                cooking_time=30, image='recipes/images/bread.jpg',
+            )
+            RecipeIngredientValue.objects.create(
+                recipe=recipe, ingredient=salt, amount=amount
+            )
+            RecipeIngredientValue.objects.create(
+                recipe=recipe, ingredient=flour, amount=100
+            )
+            self.client.post(f'/api/recipes/{recipe.pk}/shopping_cart/')
+        self.url = '/api/recipes/download_shopping_cart/'
+
+    def download(self, file_format):
+        response = self.client.get(self.url, {'format': file_format})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response
+
+    def test_text_formats_are_streamed(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            b''.join(response.streaming_content).decode(),
+            '• мука (г) — 200\n• соль (г) — 15\n'
+        )
+        response = self.download('csv')
+        self.assertIn('соль,г,15',
+                      b''.join(response.streaming_content).decode())
+        response = self.download('json')
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content))[1],
+            {'name': 'соль', 'measurement_unit': 'г', 'amount': 15}
+        )
+
+    def test_pdf_is_cached_until_cart_changes(self):
+        response = self.download('pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.content.startswith(b'%PDF'))
+        with self.assertNumQueries(0):
+            self.download('pdf')
+        recipe = Recipe.objects.get(name='Хлеб 5')
+        self.client.delete(f'/api/recipes/{recipe.pk}/shopping_cart/')
+        with self.assertNumQueries(1):
+            self.download('pdf')
+
+    def test_unknown_format(self):
+        response = self.client.get(self.url, {'format': 'xml'})
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_missing_font_fails_startup_check(self):
+        self.assertEqual(check_shopping_list_font(None), [])
+        with override_settings(SHOPPING_LIST_FONT='/nonexistent.ttf'):
+            errors = check_shopping_list_font(None)
+        self.assertEqual([error.id for error in errors], ['api.E001'])
+
+
+class ShoppingListItemTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cook', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.salt = Ingredient.objects.create(name='соль',
+                                              measurement_unit='г')
+        self.flour = Ingredient.objects.create(name='мука',
+                                               measurement_unit='г')
+        self.recipe = Recipe.objects.create(
+            name='Хлеб', author=self.user, text='текст', cooking_time=30,
+            image='recipes/images/bread.jpg',
+        )
+        RecipeIngredientValue.objects.create(
+            recipe=self.recipe, ingredient=self.salt, amount=5
+        )
+        self.url = f'/api/recipes/{self.recipe.pk}/shopping_cart/'
+
+    def totals(self):
+        return dict(self.user.shopping_list.values_list(
+            'ingredient__name', 'total_amount'
+        ))
+
+    def test_cart_changes_update_totals(self):
+        self.client.post(self.url)
+        self.assertEqual(self.totals(), {'соль': 5})
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.pk}/',
+            {'ingredients': [{'id': self.salt.pk, 'amount': 2},
+                             {'id': self.flour.pk, 'amount': 300}]},
+            format='json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(self.totals(), {'соль': 2, 'мука': 300})
+        self.client.delete(self.url)
+        self.assertEqual(self.totals(), {})
+
+    def test_deleted_recipe_leaves_shopping_list(self):
+        self.client.post(self.url)
+        self.recipe.delete()
+        self.assertEqual(self.totals(), {})
+
+    def test_model_changes_update_totals(self):
+        # Корзина и состав, измененные в обход API (админка, shell).
+        Cart.objects.create(user=self.user, recipe=self.recipe)
+        value = self.recipe.ingredient_values.get()
+        value.amount = 7
+        value.save()
+        RecipeIngredientValue.objects.create(
+            recipe=self.recipe, ingredient=self.flour, amount=100
+        )
+        self.assertEqual(self.totals(), {'соль': 7, 'мука': 100})
+        value.delete()
+        self.assertEqual(self.totals(), {'мука': 100})
+        Cart.objects.get().delete()
+        self.assertEqual(self.totals(), {})
+
+    def test_rebuild_command(self):
+        # bulk_create не отправляет сигналы, список покупок отстает.
+        Cart.objects.bulk_create([Cart(user=self.user, recipe=self.recipe)])
+        out = StringIO()
+        call_command('rebuild_shopping_lists', '--check', stdout=out)
+        self.assertIn('Stale shopping lists: 1', out.getvalue())
+        call_command('rebuild_shopping_lists', stdout=StringIO())
+        self.assertEqual(self.totals(), {'соль': 5})
+
+
+class BatchEndpointsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cook', password='p')
+        self.author = User.objects.create_user(username='chef', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        self.recipes = []
+        for number in range(3):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {number}', author=self.author, text='текст',
+                cooking_time=10, image='recipes/images/dish.jpg',
+            )
+            RecipeIngredientValue.objects.create(
+                recipe=recipe, ingredient=salt, amount=2
+            )
+            self.recipes.append(recipe)
+
+    def test_cart_batch(self):
+        first, second, third = (recipe.pk for recipe in self.recipes)
+        self.client.post(f'/api/recipes/{first}/shopping_cart/')
+        response = self.client.post(
+            '/api/recipes/shopping_cart/',
+            {'ids': [first, second, third, 999]}, format='json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([item['status'] for item in response.json()],
+                         ['exists', 'added', 'added', 'not_found'])
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(
+            self.user.shopping_list.get().total_amount, 6
+        )
+        self.assertEqual(Recipe.objects.get(pk=second).carts_count, 1)
+
+        response = self.client.delete(
+            '/api/recipes/shopping_cart/', {'ids': [first, second]},
+            format='json',
+        )
+        self.assertEqual([item['status'] for item in response.json()],
+                         ['removed', 'removed'])
+        self.assertEqual(self.user.shopping_list.get().total_amount, 2)
+        self.assertEqual(Recipe.objects.get(pk=first).carts_count, 0)
+
+    def test_favorite_batch(self):
+        ids = [recipe.pk for recipe in self.recipes]
+        response = self.client.post('/api/recipes/favorite/', {'ids': ids},
+                                    format='json')
+        self.assertEqual({item['status'] for item in response.json()},
+                         {'added'})
+        self.assertEqual(Favourite.objects.filter(user=self.user).count(), 3)
+        # Счетчики меняются только для строк, реально вставленных или
+        # удаленных, поэтому повторы их не сдвигают.
+        for method, statuses, count in (('post', {'exists'}, 1),
+                                        ('delete', {'removed'}, 0),
+                                        ('delete', {'not_found'}, 0)):
+            response = getattr(self.client, method)(
+                '/api/recipes/favorite/', {'ids': ids}, format='json'
+            )
+            self.assertEqual({item['status'] for item in response.json()},
+                             statuses)
+            self.assertEqual(
+                set(Recipe.objects.values_list('favorites_count',
+                                               flat=True)),
+                {count}
+            )
+        response = self.client.post('/api/recipes/favorite/', {'ids': []},
+                                    format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_subscribe_batch(self):
+        response = self.client.post(
+            '/api/users/subscribe/',
+            {'ids': [self.author.pk, self.user.pk]}, format='json',
+        )
+        self.assertEqual([item['status'] for item in response.json()],
+                         ['added', 'self'])
+        self.assertTrue(UserFollow.objects.filter(
+            user=self.user, following=self.author
+        ).exists())
+        self.assertEqual(self.user.feed_entries.count(), 3)
+        response = self.client.delete(
+            '/api/users/subscribe/', {'ids': [self.author.pk]},
+            format='json',
+        )
+        self.assertEqual(response.json()[0]['status'], 'removed')
+        self.assertFalse(self.user.feed_entries.exists())
+
+
+class RelationToggleTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cook', password='p')
+        self.author = User.objects.create_user(username='chef', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', author=self.author, text='текст',
+            cooking_time=10, image='recipes/images/dish.jpg',
+        )
+
+    def test_repeated_toggles_map_to_bad_request(self):
+        for url in (f'/api/recipes/{self.recipe.pk}/favorite/',
+                    f'/api/recipes/{self.recipe.pk}/shopping_cart/',
+                    f'/api/users/{self.author.pk}/subscribe/'):
+            with self.subTest(url=url):
+                response = self.client.post(url)
+                self.assertEqual(response.status_code, HTTPStatus.CREATED)
+                response = self.client.post(url)
+                self.assertEqual(response.status_code,
+                                 HTTPStatus.BAD_REQUEST)
+                response = self.client.delete(url)
+                self.assertEqual(response.status_code,
+                                 HTTPStatus.NO_CONTENT)
+                response = self.client.delete(url)
+                self.assertEqual(response.status_code,
+                                 HTTPStatus.BAD_REQUEST)
+
+    def test_repeated_subscribe_keeps_error_body(self):
+        url = f'/api/users/{self.author.pk}/subscribe/'
+        self.client.post(url)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(response.json(),
+                         {'non_field_errors': ['Подписка уже оформлена!']})
+        self.recipe.refresh_from_db()
+        self.assertEqual(
+            (self.recipe.favorites_count, self.recipe.carts_count), (0, 0)
+        )
+
+    def test_toggle_invalidates_user_flags(self):
+        cache.clear()
+        url = f'/api/recipes/{self.recipe.pk}/'
+        self.assertFalse(self.client.get(url).json()['is_favorited'])
+        self.client.post(f'{url}favorite/')
+        self.assertTrue(self.client.get(url).json()['is_favorited'])
+
+
+class SubscriptionsQueriesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for number in range(3):
+            author = User.objects.create_user(username=f'author{number}',
+                                              password='p')
+            UserFollow.objects.create(user=self.user, following=author)
+            for index in range(3):
+                Recipe.objects.create(
+                    name=f'Рецепт {number}-{index}', author=author,
+                    text='текст', cooking_time=10,
+                    image='recipes/images/dish.jpg',
+                )
+
+    def test_subscriptions_use_constant_queries(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                '/api/users/subscriptions/?recipes_limit=2'
+            )
+        results = response.json()['results']
+        self.assertEqual(len(results), 3)
+        for author in results:
+            self.assertTrue(author['is_subscribed'])
+            self.assertEqual(author['recipes_count'], 3)
+            self.assertEqual(
+                [recipe['name'] for recipe in author['recipes']],
+                [f'Рецепт {author["username"][-1]}-{index}'
+                 for index in (2, 1)]
+            )
+        response = self.client.get('/api/users/subscriptions/')
+        self.assertEqual(len(response.json()['results'][0]['recipes']), 3)
+
+
+@override_settings(FEED_FANOUT_MAX_FOLLOWERS=1)
+class FeedTestCase(TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user(username='reader',
+                                               password='p')
+        self.other = User.objects.create_user(username='other', password='p')
+        self.author = User.objects.create_user(username='author',
+                                               password='p')
+        self.star = User.objects.create_user(username='star', password='p')
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        UserFollow.objects.create(user=self.reader, following=self.author)
+        UserFollow.objects.create(user=self.reader, following=self.star)
+        UserFollow.objects.create(user=self.other, following=self.star)
+        self.recipes = [
+            self.create_recipe(author, number)
+            for number, author in enumerate(
+                [self.author, self.star, self.author, self.star, self.other]
+            )
+        ]
+
+    def create_recipe(self, author, number):
+        return Recipe.objects.create(
+            name=f'Рецепт {number}', author=author, text='текст',
+            cooking_time=10, image='recipes/images/dish.jpg',
+        )
+
+    def names(self, response):
+        return [recipe['name'] for recipe in response.json()['results']]
+
+    def test_feed_merges_timeline_and_popular_authors(self):
+        self.assertTrue(self.recipes[0].in_timelines)
+        self.assertFalse(Recipe.objects.get(pk=self.recipes[1].pk)
+                         .in_timelines)
+        self.assertEqual(self.reader.feed_entries.count(), 2)
+
+        response = self.client.get('/api/recipes/feed/?limit=3')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(self.names(response),
+                         ['Рецепт 3', 'Рецепт 2', 'Рецепт 1'])
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(self.names(response), ['Рецепт 0'])
+        self.assertIsNone(response.json()['next'])
+        response = self.client.get(response.json()['previous'])
+        self.assertEqual(self.names(response),
+                         ['Рецепт 3', 'Рецепт 2', 'Рецепт 1'])
+
+    def test_page_cost_ignores_fanned_out_authors(self):
+        def count_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get('/api/recipes/feed/?limit=3')
+            return len(queries)
+
+        before = count_queries()
+        for number in range(3):
+            author = User.objects.create_user(username=f'small{number}',
+                                              password='p')
+            UserFollow.objects.create(user=self.reader, following=author)
+            self.create_recipe(author, 10 + number)
+        # Разосланные рецепты новых авторов приходят из FeedEntry.
+        self.assertEqual(count_queries(), before)
+
+    def test_follow_and_unfollow_update_timeline(self):
+        url = f'/api/users/{self.other.pk}/subscribe/'
+        self.client.post(url)
+        response = self.client.get('/api/recipes/feed/')
+        self.assertEqual(self.names(response)[0], 'Рецепт 4')
+        self.client.delete(url)
+        self.client.delete(f'/api/users/{self.author.pk}/subscribe/')
+        response = self.client.get('/api/recipes/feed/')
+        self.assertEqual(self.names(response), ['Рецепт 3', 'Рецепт 1'])
+
+
+class UserSubscribedFlagTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='p',
+                                             email='reader@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.authors = [
+            User.objects.create_user(username=f'author{number}',
+                                     password='p',
+                                     email=f'author{number}@example.com')
+            for number in range(4)
+        ]
+        for author in self.authors[:2]:
+            UserFollow.objects.create(user=self.user, following=author)
+
+    def test_users_page_loads_subscriptions_once(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/users/?limit=10')
+        flags = {
+            user['username']: user['is_subscribed']
+            for user in response.json()['results']
+        }
+        self.assertEqual(flags, {
+            'reader': False, 'author0': True, 'author1': True,
+            'author2': False, 'author3': False,
+        })
+
+    def test_own_profile_needs_no_query(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/users/me/')
+        self.assertFalse(response.json()['is_subscribed'])
+
+
+class CachedTokenAuthenticationTestCase(TestCase):
+    def setUp(self):
+        caches['auth'].clear()
+        self.user = User.objects.create_user(
+            username='cook', password='old-pass-123',
+            email='cook@example.com',
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        self.url = '/api/users/me/'
+
+    def test_token_is_served_from_cache(self):
+        self.assertEqual(self.client.get(self.url).status_code,
+                         HTTPStatus.OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.json()['username'], 'cook')
+
+    def test_password_hash_is_not_cached(self):
+        self.user.avatar = 'users/a.png'
+        self.user.save(update_fields=['avatar'])
+        self.client.get(self.url)
+        snapshot = caches['auth'].get(token_cache_key(self.token.key))
+        self.assertEqual(snapshot['username'], 'cook')
+        self.assertEqual(snapshot['avatar'], 'users/a.png')
+        self.assertNotIn(self.user.password.encode(), pickle.dumps(snapshot))
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertTrue(response.json()['avatar'].endswith('users/a.png'))
+
+    def test_cached_user_keeps_password_on_save(self):
+        self.client.get(self.url)
+        user, _ = CachedTokenAuthentication().authenticate_credentials(
+            self.token.key
+        )
+        user.first_name = 'Повар'
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'Повар')
+        self.assertTrue(self.user.check_password('old-pass-123'))
+
+    def test_logout_forgets_token(self):
+        self.client.get(self.url)
+        response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertEqual(self.client.get(self.url).status_code,
+                         HTTPStatus.UNAUTHORIZED)
+
+    def test_password_change_and_deactivation_forget_token(self):
+        self.client.get(self.url)
+        response = self.client.post('/api/users/set_password/', {
+            'current_password': 'old-pass-123',
+            'new_password': 'new-pass-456',
+        })
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+        self.user.refresh_from_db()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code,
+                         HTTPStatus.UNAUTHORIZED)
+
+
+class SparseFieldsetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='reader', password='p',
+                                             email='reader@example.com')
+        self.author = User.objects.create_user(username='author',
+                                               password='p',
+                                               email='author@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        UserFollow.objects.create(user=self.user, following=self.author)
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', author=self.author, text='текст',
+            cooking_time=10, image='recipes/images/dish.jpg',
+        )
+
+    def test_recipe_fields_prune_queryset(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/recipes/?fields=id,name')
+        self.assertEqual(response.json()['results'],
+                         [{'id': self.recipe.pk, 'name': 'Рецепт'}])
+        sql = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('EXISTS', sql)
+        self.assertNotIn('"recipes_recipe"."text"', sql)
+        self.assertNotIn('recipes_recipeingredientvalue', sql)
+
+    def test_recipe_omit(self):
+        response = self.client.get(
+            f'/api/recipes/{self.recipe.pk}/?omit=ingredients,text'
+        )
+        data = response.json()
+        self.assertNotIn('ingredients', data)
+        self.assertNotIn('text', data)
+        self.assertTrue(data['author']['is_subscribed'])
+        full = self.client.get(f'/api/recipes/{self.recipe.pk}/')
+        self.assertEqual(full.json()['text'], 'текст')
+        self.assertNotEqual(response['ETag'], full['ETag'])
+
+    def test_user_fields(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/users/?fields=id,username')
+        self.assertEqual(set(response.json()['results'][0]),
+                         {'id', 'username'})
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                '/api/users/subscriptions/?omit=recipes,recipes_count'
+            )
+        author = response.json()['results'][0]
+        self.assertNotIn('recipes', author)
+        self.assertTrue(author['is_subscribed'])
+
+
+@override_settings(IMAGE_VARIANT_WORKERS=0)
+class ImageVariantsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = Path(media.name)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.user = User.objects.create_user(username='cook', password='p',
+                                             email='cook@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.salt = Ingredient.objects.create(name='Соль',
+                                              measurement_unit='г')
+
+    def test_variants_replace_original_when_ready(self):
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'PNG')
+        image = base64.b64encode(buffer.getvalue()).decode()
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/api/recipes/', {
+                'ingredients': [{'id': self.salt.pk, 'amount': 1}],
+                'image': f'data:image/png;base64,{image}',
+                'name': 'Рецепт', 'text': 'текст', 'cooking_time': 5,
+            }, format='json')
+        data = response.json()
+        self.assertEqual(data['image_variants']['card']['webp'],
+                         data['image'])
+
+        for callback in callbacks:
+            callback()
+        data = self.client.get(f'/api/recipes/{data["id"]}/').json()
+        self.assertTrue(
+            data['image_variants']['card']['webp'].endswith('-card.webp')
+        )
+        variants = Recipe.objects.get(pk=data['id']).image_variants
+        for variant, size in (('thumbnail', (160, 80)), ('card', (480, 240)),
+                              ('full', (1280, 640))):
+            for extension, fmt in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                with Image.open(self.media / variants[variant][extension]
+                                ) as resized:
+                    self.assertEqual((resized.format, resized.size),
+                                     (fmt, size))
+
+    def image_uri(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (400, 200), color).save(buffer, 'PNG')
+        return ('data:image/png;base64,'
+                f'{base64.b64encode(buffer.getvalue()).decode()}')
+
+    def test_replaced_image_variants_are_deleted(self):
+        payload = {
+            'ingredients': [{'id': self.salt.pk, 'amount': 1}],
+            'image': self.image_uri('red'),
+            'name': 'Рецепт', 'text': 'текст', 'cooking_time': 5,
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            pk = self.client.post('/api/recipes/', payload,
+                                  format='json').json()['id']
+        old = Recipe.objects.get(pk=pk).image_variants
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/recipes/{pk}/',
+                              {**payload, 'image': self.image_uri('blue')},
+                              format='json')
+        new = Recipe.objects.get(pk=pk).image_variants
+        self.assertNotEqual(old['source'], new['source'])
+        self.assertFalse((self.media / old['card']['webp']).exists())
+        self.assertTrue((self.media / new['card']['webp']).exists())
+
+    def test_avatar_variants_forget_cached_user(self):
+        token = Token.objects.create(user=self.user)
+        caches['auth'].set(token_cache_key(token.key), {'id': self.user.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put('/api/users/me/avatar/',
+                            {'avatar': self.image_uri('red')},
+                            format='json')
+        caches['auth'].set(token_cache_key(token.key), {'id': self.user.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            build_variants(User, self.user.pk, self.user.avatar.name)
+        self.assertIsNone(caches['auth'].get(token_cache_key(token.key)))
+
+
+class Base64ImageFieldTestCase(TestCase):
+    field = Base64ImageField()
+
+    def data_uri(self, content):
+        return f'data:image/png;base64,{base64.b64encode(content).decode()}'
+
+    def png(self, size):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    @staticmethod
+    def noise_png(side):
+        buffer = BytesIO()
+        Image.frombytes('L', (side, side), os.urandom(side * side)).save(
+            buffer, 'PNG', compress_level=0
+        )
+        return buffer.getvalue()
+
+    @override_settings(IMAGE_UPLOAD_SPOOL_SIZE=256 * 1024)
+    def test_decoding_memory_is_bounded(self):
+        # PNG около 8 МБ: данные проверяются потоком, пиксели не
+        # распаковываются.
+        content = self.noise_png(2900)
+        data = self.data_uri(content)
+        tracemalloc.start()
+        try:
+            upload = self.field.to_internal_value(data)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 2 * 2 ** 20)
+        self.assertEqual(upload.size, len(content))
+        self.assertEqual(upload.name, 'image.png')
+
+    def test_corrupted_data_is_rejected(self):
+        png = bytearray(self.noise_png(100))
+        png[len(png) // 2] ^= 0xFF
+        buffer = BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(buffer, 'JPEG')
+        jpeg = buffer.getvalue()
+        for content in (bytes(png), jpeg[:len(jpeg) // 2]):
+            with self.assertRaisesMessage(ValidationError, 'Invalid'):
+                self.field.to_internal_value(self.data_uri(content))
+
+    def test_limits_are_checked(self):
+        cases = (
+            (self.data_uri(b'x' * 2048), 'larger',
+             {'IMAGE_UPLOAD_MAX_SIZE': 1024}),
+            (self.data_uri(self.png((300, 300))), 'pixels',
+             {'IMAGE_UPLOAD_MAX_PIXELS': 200 * 200}),
+            (self.data_uri(self.png((10, 10))), 'Unsupported',
+             {'IMAGE_UPLOAD_FORMATS': ('JPEG',)}),
+            ('data:image/png;base64,@@@@', 'Invalid', {}),
+            (self.data_uri(b'not an image'), 'Invalid', {}),
+        )
+        for data, message, limits in cases:
+            with self.subTest(message), override_settings(**limits):
+                with self.assertRaisesMessage(ValidationError, message):
+                    self.field.to_internal_value(data)
@@ -1,4 +1,144 @@
-from recipes.models import RecipeIngredientValue
+from collections import Counter
+
+from django.db import connection
+from django.db.models import (BooleanField, Case, Count, Exists, F,
+                              IntegerField, OuterRef, Value, When, Window)
+from django.db.models.functions import Greatest, RowNumber
+
+from api.cache import (COVERAGE, POPULARITY, invalidate,
+                       relations_namespace)
+from cart.models import Cart, ShoppingListItem
+from recipes.models import Favourite, Recipe, RecipeIngredientValue
+from users.models import UserFollow
+
+SHOPPING_LIST_BATCH_SIZE = 1000
+
+
+def favourite_exists(user):
+    """Подзапрос EXISTS: рецепт в избранном пользователя."""
+    return Exists(Favourite.objects.filter(user=user, recipe=OuterRef('pk')))
+
+
+def cart_exists(user):
+    """Подзапрос EXISTS: рецепт в корзине пользователя."""
+    return Exists(Cart.objects.filter(user=user, recipe=OuterRef('pk')))
+
+
+# Поле ответа рецепта -> флаг, который для него нужен.
+RECIPE_FLAG_FIELDS = {
+    'is_favorited': 'is_favorited',
+    'is_in_shopping_cart': 'is_in_shopping_cart',
+    'author': 'is_author_subscribed',
+}
+
+
+def annotate_recipe_flags(queryset, user, fields=None):
+    """Добавляет к рецептам флаги избранного, корзины и подписки на автора.
+
+    fields - поля ответа: подзапросы флагов остальных полей не строятся.
+    """
+
+    flags = [
+        flag for field, flag in RECIPE_FLAG_FIELDS.items()
+        if fields is None or field in fields
+    ]
+    if user.is_anonymous:
+        false = Value(False, output_field=BooleanField())
+        return queryset.annotate(**dict.fromkeys(flags, false))
+    expressions = {
+        'is_favorited': lambda: favourite_exists(user),
+        'is_in_shopping_cart': lambda: cart_exists(user),
+        'is_author_subscribed': lambda: Exists(
+            UserFollow.objects.filter(user=user, following=OuterRef('author'))
+        ),
+    }
+    return queryset.annotate(
+        **{flag: expressions[flag]() for flag in flags}
+    )
+
+
+def followed_ids(request):
+    """Множество id авторов, на которых подписан пользователь запроса.
+
+    Читается одним запросом на весь запрос и запоминается на нем, чтобы
+    флаг is_subscribed любого числа пользователей стоил O(1) запросов.
+    """
+
+    user = request.user
+    if user.is_anonymous:
+        return frozenset()
+    ids = getattr(request, '_followed_ids', None)
+    if ids is None:
+        ids = frozenset(UserFollow.objects.filter(
+            user=user
+        ).values_list('following_id', flat=True))
+        request._followed_ids = ids
+    return ids
+
+
+def is_subscribed(request, author):
+    """Флаг подписки: аннотация объекта или множество подписок запроса."""
+
+    subscribed = getattr(author, 'is_subscribed', None)
+    if subscribed is not None:
+        return subscribed
+    if request is None or request.user.pk == author.pk:
+        return False
+    return author.pk in followed_ids(request)
+
+
+def annotate_subscriptions(queryset, user, fields=None):
+    """Добавляет к авторам число рецептов и флаг подписки пользователя.
+
+    fields - поля ответа: аннотации остальных полей не строятся.
+    """
+
+    annotations = {
+        'recipes_count': lambda: Count('author_recipes'),
+        'is_subscribed': lambda: Exists(
+            UserFollow.objects.filter(user=user, following=OuterRef('pk'))
+        ),
+    }
+    return queryset.annotate(**{
+        name: annotation() for name, annotation in annotations.items()
+        if fields is None or name in fields
+    })
+
+
+def attach_latest_recipes(authors, limit=None):
+    """Кладет в author.latest_recipes его последние limit рецептов.
+
+    Рецепты всех авторов читаются одним запросом: номер рецепта внутри
+    автора считает оконная функция ROW_NUMBER(), а отбор по нему идет
+    во внешнем SELECT, так как ORM не фильтрует по окнам.
+    """
+
+    authors = list(authors)
+    if not authors:
+        return authors
+    recipes = Recipe.objects.filter(
+        author__in=authors
+    ).only('id', 'name', 'image', 'cooking_time', 'author_id')
+    if limit is None:
+        recipes = recipes.order_by('-pub_date', '-id')
+    else:
+        ranked = recipes.annotate(recipe_rank=Window(
+            RowNumber(),
+            partition_by=[F('author_id')],
+            order_by=[F('pub_date').desc(), F('id').desc()],
+        )).order_by()
+        sql, params = ranked.query.sql_with_params()
+        recipes = Recipe.objects.raw(
+            f'SELECT * FROM ({sql}) ranked WHERE recipe_rank <= %s '
+            'ORDER BY author_id, recipe_rank',
+            (*params, limit),
+        )
+    by_author = {author.pk: [] for author in authors}
+    for recipe in recipes:
+        by_author[recipe.author_id].append(recipe)
+    for author in authors:
+        author.latest_recipes = by_author[author.pk]
+    return authors
 
 
 def create_relation_ingredient_and_value(ingredients, recipe):
@@ -13,3 +153,210 @@ def create_relation_ingredient_and_value(ingredients, recipe):
             amount=item['amount']
         ))
     RecipeIngredientValue.objects.bulk_create(objects)
+    # bulk_create не отправляет сигналы, поэтому индекс покрытия и списки
+    # покупок корзин с рецептом узнают о новых ингредиентах здесь.
+    invalidate(COVERAGE)
+    carts = recipe_carts(recipe.pk)
+    if carts:
+        amounts = Counter()
+        for item in objects:
+            amounts[item.ingredient.pk] += item.amount
+        change_shopping_lists(carts, amounts)
+
+
+def change_recipe_counter(field, delta, recipe_ids):
+    """Атомарно меняет счетчик рецептов выражением F без чтения строк.
+
+    update() не отправляет сигналы, поэтому версия популярности
+    сдвигается здесь.
+    """
+
+    Recipe.objects.filter(pk__in=recipe_ids).update(
+        **{field: F(field) + delta}
+    )
+    invalidate(POPULARITY)
+
+
+def ingredient_amounts(recipe_ids):
+    """Сумма каждого ингредиента рецептов: Counter по id ингредиента."""
+
+    amounts = Counter()
+    for ingredient_id, amount in RecipeIngredientValue.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('ingredient_id', 'amount'):
+        amounts[ingredient_id] += amount
+    return amounts
+
+
+def recipe_carts(recipe_id):
+    """id пользователей, у которых рецепт в корзине."""
+    return list(Cart.objects.filter(
+        recipe_id=recipe_id
+    ).values_list('user_id', flat=True))
+
+
+def change_shopping_lists(user_ids, deltas, sign=1):
+    """Прибавляет приращения ингредиентов к спискам покупок пользователей.
+
+    deltas - словарь {id ингредиента: приращение}, приращения могут быть
+    отрицательными, sign=-1 вычитает их. Положительные приращения
+    вносятся одним INSERT ... ON CONFLICT DO UPDATE, поэтому
+    конкурентные добавления одной позиции не конфликтуют. Позиции,
+    опустившиеся до нуля, удаляются.
+    """
+
+    deltas = {pk: sign * delta for pk, delta in deltas.items() if delta}
+    user_ids = sorted(set(user_ids))
+    if not user_ids or not deltas:
+        return
+    # Строки идут в порядке ключа, чтобы параллельные вставки не
+    # блокировали друг друга крест-накрест.
+    rows = [
+        (user_id, ingredient_id, delta)
+        for user_id in user_ids
+        for ingredient_id, delta in sorted(deltas.items())
+        if delta > 0
+    ]
+    meta = ShoppingListItem._meta
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    user, ingredient, total = (
+        quote(meta.get_field(name).column)
+        for name in ('user', 'ingredient', 'total_amount')
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), SHOPPING_LIST_BATCH_SIZE):
+            batch = rows[start:start + SHOPPING_LIST_BATCH_SIZE]
+            cursor.execute(
+                f'INSERT INTO {table} ({user}, {ingredient}, {total}) '
+                f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                f'ON CONFLICT ({user}, {ingredient}) DO UPDATE '
+                f'SET {total} = {table}.{total} + EXCLUDED.{total}',
+                [value for row in batch for value in row],
+            )
+
+    taken = {pk: -delta for pk, delta in deltas.items() if delta < 0}
+    if taken:
+        items = ShoppingListItem.objects.filter(
+            user_id__in=user_ids, ingredient_id__in=taken
+        )
+        items.update(total_amount=Greatest(
+            F('total_amount') - Case(
+                *(When(ingredient_id=pk, then=Value(amount))
+                  for pk, amount in taken.items()),
+                output_field=IntegerField(),
+            ),
+            Value(0),
+        ))
+        items.filter(total_amount=0).delete()
+
+
+def add_relations(model, field, user, ids, targets):
+    """Связывает пользователя с объектами ids одним INSERT.
+
+    model - модель связи с полями user и field, targets - queryset
+    допустимых объектов. Возвращает множества id добавленных и уже
+    связанных объектов, остальные id не найдены. Добавленными считаются
+    только строки, которые вернул INSERT ... ON CONFLICT DO NOTHING,
+    поэтому конкурентные запросы не получат одну строку дважды.
+    """
+
+    found = set(targets.filter(pk__in=ids).values_list('pk', flat=True))
+    if not found:
+        return set(), set()
+    table, columns, _ = _relation_sql(model, ('user', field))
+    rows = ', '.join(['(%s, %s)'] * len(found))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES {rows} '
+            f'ON CONFLICT DO NOTHING RETURNING {columns[1]}',
+            [value for pk in found for value in (user.pk, pk)],
+        )
+        added = {row[0] for row in cursor.fetchall()}
+    if added:
+        invalidate(relations_namespace(user.pk))
+    return added, found - added
+
+
+def remove_relations(model, field, user, ids):
+    """Удаляет связи пользователя с объектами ids, возвращает их id.
+
+    Удаленными считаются строки, которые вернул DELETE ... RETURNING.
+    Сигналы модели не отправляются.
+    """
+
+    if not ids:
+        return set()
+    table, columns, _ = _relation_sql(model, ('user', field))
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE {columns[0]} = %s '
+            f'AND {columns[1]} IN ({placeholders}) RETURNING {columns[1]}',
+            [user.pk, *ids],
+        )
+        removed = {row[0] for row in cursor.fetchall()}
+    if removed:
+        invalidate(relations_namespace(user.pk))
+    return removed
+
+
+def batch_results(ids, **groups):
+    """Итог пакетной операции по каждому id в порядке запроса.
+
+    groups - множества id по статусам, id вне групп не найдены.
+    """
+
+    results = []
+    for pk in dict.fromkeys(ids):
+        status = next(
+            (name for name, members in groups.items() if pk in members),
+            'not_found',
+        )
+        results.append({'id': pk, 'status': status})
+    return results
+
+
+def _relation_sql(model, values):
+    meta = model._meta
+    quote = connection.ops.quote_name
+    columns = [quote(meta.get_field(name).column) for name in values]
+    return quote(meta.db_table), columns, quote(meta.pk.column)
+
+
+def insert_relation(model, **values):
+    """INSERT ... ON CONFLICT DO NOTHING: id новой строки или None.
+
+    Одна запись без предварительной проверки: повторный запрос, в том
+    числе конкурентный, просто не вставляет строку. Сигналы модели не
+    отправляются, поэтому версия связей пользователя сдвигается здесь.
+    """
+
+    table, columns, pk = _relation_sql(model, values)
+    placeholders = ', '.join(['%s'] * len(values))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({", ".join(columns)}) '
+            f'VALUES ({placeholders}) ON CONFLICT DO NOTHING RETURNING {pk}',
+            list(values.values()),
+        )
+        row = cursor.fetchone()
+    if row is not None:
+        invalidate(relations_namespace(values['user']))
+    return row[0] if row else None
+
+
+def delete_relation(model, **values):
+    """DELETE ... RETURNING: id удаленной строки или None."""
+
+    table, columns, pk = _relation_sql(model, values)
+    condition = ' AND '.join(f'{column} = %s' for column in columns)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE {condition} RETURNING {pk}',
+            list(values.values()),
+        )
+        row = cursor.fetchone()
+    if row is not None:
+        invalidate(relations_namespace(values['user']))
+    return row[0] if row else None
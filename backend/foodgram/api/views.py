@@ -1,44 +1,161 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 from rest_framework import generics, permissions, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from django.db.models import Sum
 from hashids import Hashids
 
 from .pagination import CustomPagination
+from api.cache import (INGREDIENTS, POPULARITY, RECIPES, cart_namespace,
+                       get_or_build, get_version, invalidate, make_etag,
+                       relations_namespace)
+from api.coverage import coverage_index
+from api.feed import FeedPagination
+from api.ingredients import (IDENTITY, choose_encoding, ingredient_index,
+                             similar_ingredients)
+from api.mixins import (AnonymousCacheMixin, ConditionalGetMixin,
+                        conditional_response, requested_fields)
 from api.permissions import IsOwnerOrReadOnly
-from api.serializers import (FavouriteSerializer, IngredientSerializer,
-                             RecipeReadSerializer, RecipeWriteSerializer)
-from recipes.models import (Favourite, Ingredient, Recipe,
-                            RecipeIngredientValue)
+from api.renderers import CSVRenderer, PDFRenderer, TextRenderer
+from api.search import search_recipes
+from api.serializers import (BatchIdsSerializer, FavouriteSerializer,
+                             IngredientSerializer,
+                             RecipeCoverageSerializer, RecipeReadSerializer,
+                             RecipeWriteSerializer)
+from api.shopping_list import (STREAMED_FORMATS, render_pdf,
+                               shopping_list_rows)
+from api.utils import (add_relations, annotate_recipe_flags,
+                       batch_results, cart_exists, change_recipe_counter,
+                       change_shopping_lists, delete_relation,
+                       favourite_exists, ingredient_amounts,
+                       insert_relation, remove_relations)
+from cart.models import Cart
+from recipes.models import Favourite, Ingredient, Recipe
 
 User = get_user_model()
 
+RECIPE_ORDERINGS = {
+    '-pub_date': ('-pub_date', '-id'),
+    'pub_date': ('pub_date', 'id'),
+    '-favorites_count': ('-favorites_count', '-id'),
+    'favorites_count': ('favorites_count', 'id'),
+}
+CAN_COOK_LIMIT = 10
+CAN_COOK_MAX_LIMIT = 100
 
-class RecipeViewSet(viewsets.ModelViewSet):
+
+class RecipeViewSet(ConditionalGetMixin, AnonymousCacheMixin,
+                    viewsets.ModelViewSet):
     """Получить список или рецепт с возможностью редактирования и удаления."""
 
-    queryset = Recipe.objects.prefetch_related('ingredients')
+    # Ингредиенты подгружает RecipeReadSerializer, и только для рецептов,
+    # которых нет в кэше фрагментов.
+    queryset = Recipe.objects.select_related('author').defer('search_vector')
     serializer_class = RecipeWriteSerializer
     permission_classes = (IsOwnerOrReadOnly,)
     pagination_class = CustomPagination
+    cache_namespace = RECIPES
+    cache_query_params = ('page', 'limit', 'author', 'cursor', 'search',
+                          'ordering', 'fields', 'omit')
+
+    @property
+    def cursor_ordering(self):
+        return RECIPE_ORDERINGS.get(
+            self.request.query_params.get('ordering'),
+            RECIPE_ORDERINGS['-pub_date']
+        )
 
     def get_queryset(self):
-        filters = {}
+        if self.action in ('list', 'retrieve'):
+            return self.read_queryset(self.filter_recipes())
+        return annotate_recipe_flags(self.filter_recipes(),
+                                     self.request.user)
+
+    def read_queryset(self, queryset):
+        """Рецепты для чтения без колонок и подзапросов неотданных полей."""
+
+        fields = requested_fields(
+            self.request, RecipeReadSerializer.Meta.fields
+        )
+        for column in ('text', 'image_variants'):
+            if column not in fields:
+                queryset = queryset.defer(column)
+        if 'author' not in fields:
+            queryset = queryset.select_related(None)
+        return annotate_recipe_flags(queryset, self.request.user, fields)
+
+    def filter_recipes(self):
+        """Рецепты с фильтрами из запроса, без флагов пользователя."""
+
+        queryset = self.queryset
+        user = self.request.user
 
         author = self.request.query_params.get('author')
         if author:
-            filters['author'] = author
+            queryset = queryset.filter(author=author)
 
-        if not self.request.user.is_anonymous:
+        # Фильтры по избранному и корзине - полусоединения EXISTS,
+        # поэтому строки не дублируются и DISTINCT не нужен.
+        if not user.is_anonymous:
             if self.request.query_params.get('is_favorited') == '1':
-                filters['fav_recipes__user'] = self.request.user
+                queryset = queryset.filter(favourite_exists(user))
             if self.request.query_params.get('is_in_shopping_cart') == '1':
-                filters['cart_items__user'] = self.request.user
-
-        return self.queryset.filter(**filters).distinct()
+                queryset = queryset.filter(cart_exists(user))
+
+        search = self.request.query_params.get('search')
+        ordering = self.request.query_params.get('ordering')
+        if search:
+            # Курсор хранит поля сортировки, а не релевантность.
+            if ('cursor' in self.request.query_params
+                    and ordering not in RECIPE_ORDERINGS):
+                raise ValidationError({
+                    'cursor': 'Поиск по релевантности не поддерживает '
+                              'курсор: укажите ordering или page.'
+                })
+            queryset = search_recipes(queryset, search)
+
+        if ordering in RECIPE_ORDERINGS:
+            queryset = queryset.order_by(*RECIPE_ORDERINGS[ordering])
+
+        return queryset
+
+    def get_cache_namespaces(self):
+        # Счетчики популярности меняются без сдвига версии рецептов.
+        if 'favorites_count' in self.request.query_params.get('ordering', ''):
+            return (RECIPES, POPULARITY)
+        return (RECIPES,)
+
+    def get_validators(self):
+        user = self.request.user
+        versions = [
+            get_version(namespace)
+            for namespace in self.get_cache_namespaces()
+        ]
+        if user.is_anonymous:
+            return (
+                '-'.join(map(str, (RECIPES, *versions))),
+                max(versions) // 1_000_000,
+            )
+        if self.action == 'retrieve':
+            recipe = self.get_object()
+            return make_etag(
+                recipe.pk, recipe.updated_at.timestamp(),
+                *(getattr(recipe, flag, None) for flag in (
+                    'is_favorited', 'is_in_shopping_cart',
+                    'is_author_subscribed',
+                )),
+            ), None
+        # Список зависит от версий рецептов, связей пользователя и, при
+        # сортировке по популярности, счетчиков - без запросов к базе.
+        return make_etag(
+            user.pk, get_version(relations_namespace(user.pk)), *versions
+        ), None
 
     def get_serializer_class(self):
         """Получить сериализатор в зафисимости от метода запроса."""
@@ -54,7 +171,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         result = serializer.save(author=self.request.user)
         return Response(
-            RecipeReadSerializer(result, context={'request': request}).data,
+            self._read_data(result),
             status=status.HTTP_201_CREATED
         )
 
@@ -68,10 +185,20 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         result = serializer.save()
         return Response(
-            RecipeReadSerializer(result, context={'request': request}).data,
+            self._read_data(result),
             status=status.HTTP_200_OK
         )
 
+    def _read_data(self, recipe):
+        """Данные рецепта для ответа на запись, с флагами пользователя."""
+
+        recipe = annotate_recipe_flags(
+            self.queryset, self.request.user
+        ).get(pk=recipe.pk)
+        return RecipeReadSerializer(
+            recipe, context={'request': self.request}
+        ).data
+
     @action(
         detail=True,
         methods=['get'],
@@ -93,57 +220,207 @@ class RecipeViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK
         )
 
+    @action(
+        detail=False,
+        methods=['get'],
+        permission_classes=(permissions.AllowAny,),
+    )
+    def can_cook(self, request):
+        """Рецепты, лучше всего покрываемые имеющимися ингредиентами."""
+
+        try:
+            ingredient_ids = [
+                int(value)
+                for values in request.query_params.getlist('ingredients')
+                for value in values.split(',') if value
+            ]
+            limit = int(request.query_params.get('limit', CAN_COOK_LIMIT))
+        except ValueError:
+            raise ValidationError(
+                'Ингредиенты и лимит должны быть целыми числами.'
+            )
+        if not ingredient_ids:
+            raise ValidationError('Необходимо указать ингредиенты.')
+        limit = min(max(limit, 1), CAN_COOK_MAX_LIMIT)
+
+        top = coverage_index.top(ingredient_ids, limit)
+        recipes = Recipe.objects.defer('search_vector').in_bulk(
+            [recipe_id for recipe_id, _, _ in top]
+        )
+        results = []
+        for recipe_id, matched, total in top:
+            recipe = recipes.get(recipe_id)
+            if recipe is None:
+                coverage_index.discard([recipe_id])
+                continue
+            recipe.matched_ingredients = matched
+            recipe.total_ingredients = total
+            results.append(recipe)
+        serializer = RecipeCoverageSerializer(
+            results, many=True, context={'request': request}
+        )
+        return Response(serializer.data)
+
+    @action(
+        detail=False,
+        permission_classes=(permissions.IsAuthenticated,),
+        pagination_class=FeedPagination,
+    )
+    def feed(self, request):
+        """Лента: новые рецепты авторов, на которых подписан пользователь."""
+        page = self.paginate_queryset(self.read_queryset(self.queryset))
+        serializer = RecipeReadSerializer(
+            page, many=True, context=self.get_serializer_context()
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=False,
+        methods=['post', 'delete'],
+        url_path='shopping_cart',
+        permission_classes=(permissions.IsAuthenticated,),
+    )
+    def shopping_cart_batch(self, request):
+        """Добавить в корзину или убрать из нее несколько рецептов."""
+        serializer = BatchIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+
+        with transaction.atomic():
+            if request.method == 'POST':
+                added, existing = add_relations(
+                    Cart, 'recipe', user, ids, Recipe.objects.all()
+                )
+                change_recipe_counter('carts_count', 1, added)
+                change_shopping_lists([user.pk], ingredient_amounts(added))
+                results = batch_results(ids, added=added, exists=existing)
+            else:
+                removed = remove_relations(Cart, 'recipe', user, ids)
+                change_recipe_counter('carts_count', -1, removed)
+                change_shopping_lists([user.pk], ingredient_amounts(removed),
+                                      sign=-1)
+                results = batch_results(ids, removed=removed)
+            invalidate(cart_namespace(user.pk))
+        return Response(results)
+
+    @action(
+        detail=False,
+        methods=['post', 'delete'],
+        url_path='favorite',
+        permission_classes=(permissions.IsAuthenticated,),
+    )
+    def favorite_batch(self, request):
+        """Добавить в избранное или убрать из него несколько рецептов."""
+        serializer = BatchIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+
+        with transaction.atomic():
+            if request.method == 'POST':
+                added, existing = add_relations(
+                    Favourite, 'recipe', user, ids, Recipe.objects.all()
+                )
+                change_recipe_counter('favorites_count', 1, added)
+                results = batch_results(ids, added=added, exists=existing)
+            else:
+                removed = remove_relations(Favourite, 'recipe', user, ids)
+                change_recipe_counter('favorites_count', -1, removed)
+                results = batch_results(ids, removed=removed)
+        return Response(results)
+
     @action(
         detail=False,
         permission_classes=(permissions.IsAuthenticated,),
         methods=['get'],
+        renderer_classes=(TextRenderer, CSVRenderer, JSONRenderer,
+                          PDFRenderer),
     )
     def download_shopping_cart(self, request):
-        """Загрузить файл со списком покупок."""
+        """Загрузить файл со списком покупок.
+
+        Формат задается ?format=txt|csv|json|pdf. Текстовые форматы
+        отдаются потоком по мере чтения из базы, PDF кэшируется до
+        изменения корзины или рецептов.
+        """
         user = request.user
+        file_format = request.query_params.get('format') or 'txt'
 
-        ingredients = (
-            RecipeIngredientValue.objects
-            .filter(recipe__cart_items__user=user)
-            .values(
-                'ingredient',
-                'ingredient__name',
-                'ingredient__measurement_unit'
+        if file_format == 'pdf':
+            key = (
+                f'shopping-list-pdf:{user.pk}:'
+                f'{get_version(cart_namespace(user.pk))}:'
+                f'{get_version(RECIPES)}'
             )
-            .annotate(total_amount=Sum('amount'))
-            .order_by('ingredient__name')
-        )
-
-        shopping_list = [
-            (
-                f"• {ingredient['ingredient__name']} "
-                f"({ingredient['ingredient__measurement_unit']}) — "
-                f"{ingredient['total_amount']}"
+            body = get_or_build(
+                key,
+                lambda: render_pdf(shopping_list_rows(user),
+                                   f'Список покупок {user.username}'),
+                settings.SHOPPING_LIST_CACHE_TIMEOUT,
+            )
+            response = HttpResponse(body, content_type='application/pdf')
+        else:
+            content_type, render = STREAMED_FORMATS[file_format]
+            response = StreamingHttpResponse(
+                render(shopping_list_rows(user)), content_type=content_type
             )
-            for ingredient in ingredients
-        ]
 
-        filename = f'{user.username}_shopping_list.txt'
-        response = HttpResponse(
-            '\n'.join(shopping_list), content_type='text/plain; charset=utf-8'
-        )
+        filename = f'{user.username}_shopping_list.{file_format}'
         response['Content-Disposition'] = f'attachment; filename={filename}'
         return response
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """Возвращает ингредиент или список ингредиентов. """
 
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
 
-    def get_queryset(self):
-        name = self.request.query_params.get('name')
-        queryset = super().get_queryset()
-        if name:
-            queryset = queryset.filter(name__istartswith=name)
-        return queryset.distinct()
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return self._full_list(request)
+        return self._conditional_response(self._search, request, name)
+
+    def _full_list(self, request):
+        """Готовый и заранее сжатый JSON всех ингредиентов."""
+
+        encoding = choose_encoding(request)
+        body, etag = ingredient_index.payload(encoding)
+
+        def build():
+            response = HttpResponse(body, content_type='application/json')
+            if encoding != IDENTITY:
+                response['Content-Encoding'] = encoding
+            return response
+
+        response = conditional_response(request, etag, None, build)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def _search(self, request, name):
+        """Подсказки по названию из индекса в памяти, без запроса к базе.
+
+        Если по началу и подстроке ничего не нашлось, ищет похожие
+        названия: запрос мог быть набран с опечаткой.
+        """
+        try:
+            limit = int(request.query_params.get(
+                'limit', settings.INGREDIENT_SEARCH_LIMIT
+            ))
+        except ValueError:
+            limit = settings.INGREDIENT_SEARCH_LIMIT
+        limit = min(max(limit, 1), settings.INGREDIENT_SEARCH_LIMIT)
+        results = ingredient_index.search(name, limit)
+        if not results:
+            results = similar_ingredients(name, limit)
+        return Response(results)
+
+    def get_validators(self):
+        version = get_version(INGREDIENTS)
+        return f'{INGREDIENTS}-{version}', version // 1_000_000
 
 
 class FavouritesViewSet(generics.CreateAPIView, generics.DestroyAPIView):
@@ -159,22 +436,27 @@ class FavouritesViewSet(generics.CreateAPIView, generics.DestroyAPIView):
         recipe = get_object_or_404(Recipe, pk=self.kwargs['pk'])
         user = request.user
 
-        if user.fav_recipes.filter(recipe=recipe).exists():
-            return Response({'message': 'Рецепт уже добавлен!'},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        favourite = Favourite.objects.create(recipe=recipe, user=user)
-        serializer = FavouriteSerializer(favourite)
+        with transaction.atomic():
+            pk = insert_relation(Favourite, user=user.pk, recipe=recipe.pk)
+            if pk is None:
+                return Response({'message': 'Рецепт уже добавлен!'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            change_recipe_counter('favorites_count', 1, [recipe.pk])
+        serializer = FavouriteSerializer(
+            Favourite(pk=pk, user=user, recipe=recipe)
+        )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete(self, request, *args, **kwargs):
         """Удалить рецепт из избранного."""
 
         recipe = get_object_or_404(Recipe, pk=self.kwargs['pk'])
-        deleted, _ = request.user.fav_recipes.filter(recipe=recipe).delete()
-
-        if not deleted:
-            return Response({'message': 'Рецепта нет!'},
-                            status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            deleted = delete_relation(Favourite, user=request.user.pk,
+                                      recipe=recipe.pk)
+            if deleted is None:
+                return Response({'message': 'Рецепта нет!'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            change_recipe_counter('favorites_count', -1, [recipe.pk])
 
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from cart.models import ShoppingListItem
+from recipes.models import RecipeIngredientValue
+
+
+def actual_totals():
+    """Итоги списков покупок, посчитанные заново по корзинам."""
+    totals = (
+        RecipeIngredientValue.objects
+        .filter(recipe__cart_items__isnull=False)
+        .values_list('recipe__cart_items__user', 'ingredient')
+        .annotate(total_amount=Sum('amount'))
+        .order_by()
+    )
+    return {
+        (user_id, ingredient_id): total_amount
+        for user_id, ingredient_id, total_amount in totals.iterator()
+    }
+
+
+class Command(BaseCommand):
+    help = 'Recalculate shopping list items from carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report users with stale shopping lists',
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        expected = actual_totals()
+        stored = {
+            (user_id, ingredient_id): total_amount
+            for user_id, ingredient_id, total_amount in
+            ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'total_amount'
+            ).iterator()
+        }
+        stale_users = {
+            user_id for (user_id, _), _ in expected.items() ^ stored.items()
+        }
+
+        if options['check']:
+            self.stdout.write(f'Stale shopping lists: {len(stale_users)}')
+            return
+        ShoppingListItem.objects.filter(user_id__in=stale_users).delete()
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                             total_amount=total_amount)
+            for (user_id, ingredient_id), total_amount in expected.items()
+            if user_id in stale_users
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f'Shopping lists rebuilt: {len(stale_users)}')
+        )
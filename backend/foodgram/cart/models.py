@@ -1,7 +1,7 @@
 from django.contrib.auth import get_user_model
 from django.db import models
 
-from recipes.models import Recipe
+from recipes.models import Ingredient, Recipe
 
 User = get_user_model()
 
@@ -39,3 +39,36 @@ class Cart(models.Model):
             f'Пользователь {self.user} добавил рецепт "{self.recipe}" '
             'в корзину'
         )
+
+
+class ShoppingListItem(models.Model):
+    """Итог по ингредиенту в списке покупок пользователя.
+
+    Поддерживается приращениями при изменении корзины и рецептов в ней,
+    чтобы выгрузка списка была простым чтением.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Ингредиент',
+    )
+    total_amount = models.PositiveIntegerField('Количество')
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ingredient'],
+                                    name='unique_shopping_list_item')
+        ]
+
+    def __str__(self):
+        return f'{self.ingredient} — {self.total_amount}'
@@ -1,9 +1,13 @@
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from api.serializers import RecipeForUserSerializer
+from api.cache import cart_namespace, invalidate
+from api.utils import (change_recipe_counter, change_shopping_lists,
+                       delete_relation, ingredient_amounts, insert_relation)
 from cart.models import Cart
 from recipes.models import Recipe
 
@@ -16,24 +20,29 @@ class CartAPI(APIView):
     def post(self, request, pk):
         recipe = get_object_or_404(Recipe, pk=pk)
         user = request.user
-        if user.cart.filter(recipe=recipe).exists():
-            return Response(
-                {'message': 'Рецепт уже в корзине!'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        Cart.objects.create(user=user, recipe=recipe)
+        with transaction.atomic():
+            if insert_relation(Cart, user=user.pk, recipe=recipe.pk) is None:
+                return Response(
+                    {'message': 'Рецепт уже в корзине!'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            change_recipe_counter('carts_count', 1, [recipe.pk])
+            change_shopping_lists([user.pk], ingredient_amounts([recipe.pk]))
+            invalidate(cart_namespace(user.pk))
         serializer = self.serializer_class(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete(self, request, pk):
         recipe = get_object_or_404(Recipe, pk=pk)
-        cart_item = request.user.cart.filter(recipe=recipe)
-        if cart_item.exists():
-            cart_item.delete()
-            return Response(
-                status=status.HTTP_204_NO_CONTENT
-            )
-        return Response(
-            {'message': 'Рецепта в корзине нет!'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        user = request.user
+        with transaction.atomic():
+            if delete_relation(Cart, user=user.pk, recipe=recipe.pk) is None:
+                return Response(
+                    {'message': 'Рецепта в корзине нет!'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            change_recipe_counter('carts_count', -1, [recipe.pk])
+            change_shopping_lists([user.pk], ingredient_amounts([recipe.pk]),
+                                  sign=-1)
+            invalidate(cart_namespace(user.pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
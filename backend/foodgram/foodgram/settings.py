@@ -25,6 +25,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
@@ -77,6 +78,72 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', '/tmp/foodgram_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10_000)),
+        },
+    },
+    # Общий для процессов кэш: удаление снимка при выходе должно дойти до
+    # всех воркеров. Хеш пароля в снимки не попадает.
+    'auth': {
+        'BACKEND': os.getenv(
+            'AUTH_CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'
+        ),
+        'LOCATION': os.getenv('AUTH_CACHE_LOCATION',
+                              '/tmp/foodgram_auth_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('AUTH_CACHE_MAX_ENTRIES', 10_000)),
+        },
+    },
+}
+
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 300))
+
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 300))
+
+RECIPE_FRAGMENT_TIMEOUT = int(os.getenv('RECIPE_FRAGMENT_TIMEOUT', 86400))
+
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 50))
+
+INGREDIENT_SIMILARITY_THRESHOLD = float(
+    os.getenv('INGREDIENT_SIMILARITY_THRESHOLD', 0.3)
+)
+
+FEED_FANOUT_MAX_FOLLOWERS = int(
+    os.getenv('FEED_FANOUT_MAX_FOLLOWERS', 1000)
+)
+
+IMAGE_UPLOAD_MAX_SIZE = int(
+    os.getenv('IMAGE_UPLOAD_MAX_SIZE', 10 * 1024 * 1024)
+)
+
+IMAGE_UPLOAD_MAX_PIXELS = int(
+    os.getenv('IMAGE_UPLOAD_MAX_PIXELS', 40_000_000)
+)
+
+IMAGE_UPLOAD_SPOOL_SIZE = int(
+    os.getenv('IMAGE_UPLOAD_SPOOL_SIZE', 1024 * 1024)
+)
+
+IMAGE_UPLOAD_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', 2))
+
+SHOPPING_LIST_CACHE_TIMEOUT = int(
+    os.getenv('SHOPPING_LIST_CACHE_TIMEOUT', 86400)
+)
+
+SHOPPING_LIST_FONT = os.getenv(
+    'SHOPPING_LIST_FONT', str(BASE_DIR / 'api' / 'fonts' / 'DejaVuSans.ttf')
+)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -98,7 +165,7 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
 
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.CustomPagination',
@@ -23,12 +23,8 @@ class FavouriteInline(admin.TabularInline):
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
     list_display = (
-        'name', 'author', 'get_favorite_count'
+        'name', 'author', 'favorites_count'
     )
     inlines = [RecipeIngredientValueAdmin]
     list_filter = ('name', 'author__username')
     search_fields = ('name', 'author__username')
-
-    @admin.display(description='В избранном')
-    def get_favorite_count(self, obj):
-        return obj.fav_recipes.count()
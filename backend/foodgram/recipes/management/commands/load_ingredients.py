@@ -1,21 +1,108 @@
+import csv
 import json
-from django.core.management.base import BaseCommand
-from recipes.models import Ingredient  # Импорт модели ингредиентов
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.cache import INGREDIENTS, invalidate
+from recipes.models import Ingredient
+
+BATCH_SIZE = 1000
+READ_SIZE = 64 * 1024
+
+
+def read_csv(file):
+    """Строки «название,единица» без заголовка."""
+    for row in csv.reader(file):
+        if len(row) >= 2:
+            yield row[0], row[1]
+
+
+def read_json(file):
+    """Объекты JSON-массива по одному, не загружая файл целиком."""
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    while True:
+        chunk = file.read(READ_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if not started and position < len(buffer):
+                if buffer[position] != '[':
+                    raise ValueError('Ожидался JSON-массив.')
+                started = True
+                position += 1
+                continue
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break
+            yield item['name'], item['measurement_unit']
+        if not chunk:
+            return
+
+
+READERS = {'.csv': read_csv, '.json': read_json}
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 
 class Command(BaseCommand):
-    help = 'Load ingredients from JSON file'
+    help = 'Load ingredients from a CSV or JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=settings.BASE_DIR / 'ingredients.json',
+            help='CSV (name,unit) or JSON file, ingredients.json by default',
+        )
 
-    def handle(self, *args, **kwargs):
-        with open('ingredients.json', 'r', encoding='utf-8') as file:
-            data = json.load(file)  # загружаем список словарей
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        reader = READERS.get(path.suffix.lower())
+        if reader is None:
+            raise CommandError(f'Unsupported file type: {path.suffix}')
 
-        for item in data:
-            ingredient, created = Ingredient.objects.get_or_create(
-                name=item['name'],
-                defaults={'measurement_unit': item['measurement_unit']}
+        existing = set(
+            Ingredient.objects.order_by().values_list(
+                'name', 'measurement_unit'
+            )
+        )
+        total = added = 0
+        with open(path, encoding='utf-8') as file:
+            rows = (
+                (name.strip(), unit.strip()) for name, unit in reader(file)
             )
-            if created:
-                self.stdout.write(f"Added ingredient: {ingredient.name}")
-            else:
-                self.stdout.write(f"Ingredient already exists: {ingredient.name}")
+            for batch in batches(rows, BATCH_SIZE):
+                total += len(batch)
+                new = []
+                for pair in batch:
+                    if pair[0] and pair not in existing:
+                        existing.add(pair)
+                        new.append(Ingredient(
+                            name=pair[0], measurement_unit=pair[1]
+                        ))
+                if new:
+                    Ingredient.objects.bulk_create(new, ignore_conflicts=True)
+                    added += len(new)
+        if added:
+            invalidate(INGREDIENTS)
 
+        self.stdout.write(self.style.SUCCESS(
+            f'Ingredients read: {total}, added: {added}, '
+            f'skipped: {total - added}'
+        ))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from api.cache import POPULARITY, invalidate
+from cart.models import Cart
+from recipes.models import Favourite, Recipe
+
+
+def count_of(model):
+    """Подзапрос: число строк model, ссылающихся на рецепт."""
+    return Coalesce(Subquery(
+        model.objects.filter(recipe=OuterRef('pk')).order_by()
+        .values('recipe').annotate(count=Count('pk')).values('count')
+    ), 0)
+
+
+class Command(BaseCommand):
+    help = 'Recalculate favorites_count and carts_count of recipes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report recipes with stale counters',
+        )
+
+    def handle(self, *args, **options):
+        stale = Recipe.objects.annotate(
+            actual_favorites=count_of(Favourite),
+            actual_carts=count_of(Cart),
+        ).filter(
+            ~Q(favorites_count=F('actual_favorites'))
+            | ~Q(carts_count=F('actual_carts'))
+        ).values_list('pk', flat=True)
+        stale_ids = list(stale)
+
+        if options['check']:
+            self.stdout.write(f'Stale recipe counters: {len(stale_ids)}')
+            return
+        updated = Recipe.objects.filter(pk__in=stale_ids).update(
+            favorites_count=count_of(Favourite),
+            carts_count=count_of(Cart),
+        )
+        if updated:
+            invalidate(POPULARITY)
+        self.stdout.write(
+            self.style.SUCCESS(f'Recipe counters fixed: {updated}')
+        )
@@ -0,0 +1,95 @@
+# Generated by Django 3.2.16 on 2026-10-18 06:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+# Значение FEED_FANOUT_MAX_FOLLOWERS на момент миграции.
+FANOUT_MAX_FOLLOWERS = 1000
+BATCH_SIZE = 1000
+
+
+def fill_timelines(apps, schema_editor):
+    """Рассылает существующие рецепты авторов с небольшим числом
+    подписчиков в ленты, остальные будут читаться при запросе."""
+    Recipe = apps.get_model('recipes', 'Recipe')
+    FeedEntry = apps.get_model('recipes', 'FeedEntry')
+    UserFollow = apps.get_model('users', 'UserFollow')
+    popular = (
+        UserFollow.objects.values('following')
+        .annotate(followers=Count('id'))
+        .filter(followers__gt=FANOUT_MAX_FOLLOWERS)
+        .values('following')
+    )
+    Recipe.objects.exclude(author__in=popular).update(in_timelines=True)
+    rows = UserFollow.objects.filter(
+        following__author_recipes__in_timelines=True
+    ).values_list(
+        'user_id', 'following__author_recipes', 'following_id',
+        'following__author_recipes__pub_date',
+    )
+    batch = []
+    for user_id, recipe_id, author_id, pub_date in rows.iterator():
+        batch.append(FeedEntry(user_id=user_id, recipe_id=recipe_id,
+                               author_id=author_id, pub_date=pub_date))
+        if len(batch) >= BATCH_SIZE:
+            FeedEntry.objects.bulk_create(batch)
+            batch = []
+    FeedEntry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0010_ingredient_name_trigram_index'),
+        ('users', '0004_alter_user_avatar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(verbose_name='Дата публикации')),
+            ],
+            options={
+                'verbose_name': 'Запись ленты',
+                'verbose_name_plural': 'Ленты подписок',
+            },
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_timelines',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Разослан в ленты подписчиков'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='recipe_author_pub_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='author',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Автор рецепта'),
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='recipe',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='recipes.recipe', verbose_name='Рецепт'),
+        ),
+        migrations.AddField(
+            model_name='feedentry',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to=settings.AUTH_USER_MODEL, verbose_name='Подписчик'),
+        ),
+        migrations.AddIndex(
+            model_name='feedentry',
+            index=models.Index(fields=['user', '-pub_date', '-recipe'], name='feed_user_pub_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='feedentry',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_feed_entry'),
+        ),
+        migrations.RunPython(fill_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-18 06:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_recipe_updated_at_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('in_timelines', False)), fields=['author', '-pub_date', '-id'], name='recipe_author_unfanned_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
 
@@ -57,6 +58,12 @@ class Recipe(models.Model):
         upload_to='recipes/',
         blank=True
     )
+    image_variants = models.JSONField(
+        'Уменьшенные копии изображения',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     name = models.CharField(
         'Название рецепта',
         max_length=256,
@@ -76,11 +83,50 @@ class Recipe(models.Model):
         'Дата публикации',
         auto_now_add=True,
     )
+    updated_at = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True,
+    )
+    favorites_count = models.PositiveIntegerField(
+        'В избранном',
+        default=0,
+        editable=False,
+    )
+    carts_count = models.PositiveIntegerField(
+        'В корзинах',
+        default=0,
+        editable=False,
+    )
+    search_vector = SearchVectorField(
+        'Поисковый вектор',
+        null=True,
+        editable=False,
+    )
+    in_timelines = models.BooleanField(
+        'Разослан в ленты подписчиков',
+        default=False,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-pub_date',)
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['-favorites_count', '-id'],
+                         name='recipe_favorites_count_idx'),
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         name='recipe_author_pub_date_idx'),
+            models.Index(fields=['updated_at'],
+                         name='recipe_updated_at_idx'),
+            # Неразосланные рецепты популярных авторов читаются в ленты
+            # при запросе.
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         condition=models.Q(in_timelines=False),
+                         name='recipe_author_unfanned_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -164,3 +210,48 @@ class Favourite(models.Model):
             f'Пользователь {self.user} добавил рецепт '
             f'"{self.recipe}" в избранное'
         )
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте подписчика, разосланный при публикации.
+
+    Рецепты авторов с большим числом подписчиков не рассылаются, а
+    читаются при запросе ленты.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Подписчик',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт',
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор рецепта',
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-recipe'],
+                         name='feed_user_pub_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe} в ленте {self.user}'
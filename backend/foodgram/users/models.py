@@ -50,6 +50,12 @@ class User(AbstractUser):
     avatar = models.ImageField(
         'Аватар', upload_to='users/', blank=True, null=True
     )
+    avatar_variants = models.JSONField(
+        'Уменьшенные копии аватара',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
 
     role = models.CharField(
         max_length=ROLE_MAX_LENGTH,
@@ -1,8 +1,12 @@
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxLengthValidator, RegexValidator
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from rest_framework.validators import UniqueValidator
 from api.serializers import RecipeForUserSerializer, Base64ImageField
+from api.feed import backfill_timeline
+from api.mixins import SparseFieldsetMixin
+from api.utils import insert_relation, is_subscribed
 from users.models import UserFollow
 
 EMAIL_MAX_LENGTH = 254
@@ -93,8 +97,14 @@ class AvatarSerializer(serializers.ModelSerializer):
         model = User
         fields = ('avatar',)
 
+    def update(self, instance, validated_data):
+        instance.avatar = validated_data['avatar']
+        instance.save(update_fields=['avatar'])
+        return instance
 
-class UserSubscriptionsSerializer(serializers.ModelSerializer):
+
+class UserSubscriptionsSerializer(SparseFieldsetMixin,
+                                  serializers.ModelSerializer):
     """Сериализатор для подписок пользователя"""
 
     avatar = Base64ImageField(required=False, allow_null=True)
@@ -112,25 +122,24 @@ class UserSubscriptionsSerializer(serializers.ModelSerializer):
 
     def get_recipes(self, obj):
         request = self.context.get('request')
-        recipes = obj.author_recipes.all()
-        limit = request.query_params.get('recipes_limit')
-
-        if limit and limit.isdigit():
-            recipes = recipes[:int(limit)]
+        recipes = getattr(obj, 'latest_recipes', None)
+        if recipes is None:
+            recipes = obj.author_recipes.all()
+            limit = request.query_params.get('recipes_limit')
+            if limit and limit.isdigit():
+                recipes = recipes[:int(limit)]
 
         return RecipeForUserSerializer(recipes, many=True,
                                        context={'request': request}).data
 
     def get_recipes_count(self, obj):
+        count = getattr(obj, 'recipes_count', None)
+        if count is not None:
+            return count
         return obj.author_recipes.count()
 
     def get_is_subscribed(self, obj):
-        request = self.context.get('request')
-        user = request.user if request else None
-
-        if user and not user.is_anonymous:
-            return user.following.filter(following=obj).exists()
-        return False
+        return is_subscribed(self.context.get('request'), obj)
 
 
 class SubscriptionCreateSerializer(serializers.ModelSerializer):
@@ -146,13 +155,20 @@ class SubscriptionCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 'Нельзя подписаться на самого себя!'
             )
-        if user.following.filter(following=following).exists():
-            raise serializers.ValidationError('Подписка уже оформлена!')
         return data
 
     def create(self, validated_data):
-        validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        user = self.context['request'].user
+        following = validated_data['following']
+        pk = insert_relation(UserFollow, user=user.pk,
+                             following=following.pk)
+        if pk is None:
+            # Тот же ответ, что давала проверка в validate().
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ['Подписка уже оформлена!']
+            })
+        backfill_timeline(user.pk, [following.pk])
+        return UserFollow(pk=pk, user=user, following=following)
 
 
 class ChangePasswordSerializer(serializers.ModelSerializer):
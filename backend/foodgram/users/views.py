@@ -1,11 +1,19 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from api.cache import make_etag
+from api.feed import backfill_timeline, prune_timeline
+from api.mixins import conditional_response, requested_fields
 from api.pagination import CustomPagination
 
-from api.serializers import UserSerializer
+from api.serializers import BatchIdsSerializer, UserSerializer
+from api.utils import (add_relations, annotate_subscriptions,
+                       attach_latest_recipes, batch_results, delete_relation,
+                       remove_relations)
+from users.models import UserFollow
 from users.serializers import (ChangePasswordSerializer, UserCreateSerializer,
                                UserSubscriptionsSerializer, AvatarSerializer,
                                SubscriptionCreateSerializer)
@@ -13,12 +21,18 @@ from users.serializers import (ChangePasswordSerializer, UserCreateSerializer,
 User = get_user_model()
 
 
+def parse_recipes_limit(value):
+    """Число рецептов автора из ?recipes_limit= или None, если не задано."""
+    return int(value) if value and value.isdigit() else None
+
+
 class UserViewSet(viewsets.ModelViewSet):
 
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (permissions.AllowAny,)
     pagination_class = CustomPagination
+    cursor_ordering = ('id',)
 
     def get_serializer_class(self):
         if self.action == 'subscriptions':
@@ -38,9 +52,19 @@ class UserViewSet(viewsets.ModelViewSet):
     def subscriptions(self, request):
         """Возвращает подписки с рецептами."""
 
-        subscriptions = User.objects.filter(followers__user=request.user)
+        fields = requested_fields(
+            request, UserSubscriptionsSerializer.Meta.fields
+        )
+        subscriptions = annotate_subscriptions(
+            User.objects.filter(followers__user=request.user), request.user,
+            fields,
+        ).order_by('id')
         page = self.paginate_queryset(subscriptions)
         recipes_limit = request.query_params.get('recipes_limit')
+        if 'recipes' in fields:
+            page = attach_latest_recipes(
+                page, parse_recipes_limit(recipes_limit)
+            )
         serializer = self.get_serializer(
             page,
             many=True,
@@ -64,14 +88,19 @@ class UserViewSet(viewsets.ModelViewSet):
 
     @subscribe.mapping.post
     def subscribe_post(self, request, pk=None):
-        author = get_object_or_404(User, id=pk)
+        author = get_object_or_404(
+            annotate_subscriptions(User.objects.all(), request.user), id=pk
+        )
         serializer = SubscriptionCreateSerializer(
             data={'following': author.id},
             context={'request': request}
         )
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with transaction.atomic():
+            serializer.save()
+        author.is_subscribed = True
         recipes_limit = request.query_params.get('recipes_limit')
+        attach_latest_recipes([author], parse_recipes_limit(recipes_limit))
         response_serializer = UserSubscriptionsSerializer(
             author,
             context={
@@ -90,13 +119,44 @@ class UserViewSet(viewsets.ModelViewSet):
         user = request.user
         author = get_object_or_404(User, id=pk)
 
-        deleted, _ = user.following.filter(following=author).delete()
-        if not deleted:
-            return Response({'detail': 'Подписка не найдена.'},
-                            status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            if delete_relation(UserFollow, user=user.pk,
+                               following=author.pk) is None:
+                return Response({'detail': 'Подписка не найдена.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            prune_timeline(user.pk, [author.pk])
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        detail=False,
+        methods=['post', 'delete'],
+        url_path='subscribe',
+        permission_classes=(permissions.IsAuthenticated,)
+    )
+    def subscribe_batch(self, request):
+        """Подписаться на нескольких авторов или отписаться от них."""
+        serializer = BatchIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+
+        with transaction.atomic():
+            if request.method == 'POST':
+                added, existing = add_relations(
+                    UserFollow, 'following', user, ids,
+                    User.objects.exclude(pk=user.pk)
+                )
+                backfill_timeline(user.pk, added)
+                results = batch_results(ids, added=added, exists=existing,
+                                        self={user.pk})
+            else:
+                removed = remove_relations(UserFollow, 'following', user,
+                                           ids)
+                prune_timeline(user.pk, removed)
+                results = batch_results(ids, removed=removed)
+        return Response(results)
+
     @action(
         methods=['get'],
         detail=False,
@@ -104,8 +164,15 @@ class UserViewSet(viewsets.ModelViewSet):
     )
     def me(self, request):
         """Возвращает текущего пользователя."""
-        serializer = self.get_serializer(request.user)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        user = request.user
+        etag = make_etag(user.pk, user.email, user.username,
+                         user.first_name, user.last_name, user.avatar,
+                         user.avatar_variants.get('source'))
+        return conditional_response(
+            request, etag, None,
+            lambda: Response(self.get_serializer(user).data,
+                             status=status.HTTP_200_OK)
+        )
 
     @action(
         methods=['put', 'delete'],
@@ -137,10 +204,10 @@ class UserViewSet(viewsets.ModelViewSet):
                 )
             if user.avatar.name.startswith('data:image'):
                 user.avatar = ''
-                user.save()
+                user.save(update_fields=['avatar'])
                 return Response(status=status.HTTP_204_NO_CONTENT)
-            user.avatar.delete()
-            user.save()
+            user.avatar.delete(save=False)
+            user.save(update_fields=['avatar'])
             return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -167,5 +234,5 @@ class UserViewSet(viewsets.ModelViewSet):
             )
 
         request.user.set_password(serializer.validated_data['new_password'])
-        request.user.save()
+        request.user.save(update_fields=['password'])
         return Response(status=status.HTTP_204_NO_CONTENT)